@@ -33,7 +33,8 @@ setup(
     ],
     keywords='Lua pattern matching regex regular expressions',
     package_dir={'': 'src'},
-    py_modules=["luapatt"],
+    packages=find_packages('src'),
     install_requires=[],  # no dependencies
-    extras_require={'test': ['pytest']}
+    extras_require={'test': ['pytest'], 'numpy': ['numpy']},
+    entry_points={'console_scripts': ['luapatt = luapatt:main']}
 )
@@ -0,0 +1,3665 @@
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from array import array
+import bisect
+from collections import OrderedDict
+from collections.abc import Mapping
+import io
+import mmap
+import os
+import pickle
+import string
+import struct
+import sys
+import threading
+import unicodedata
+import zlib
+
+__version__ = '0.9.0b5'
+
+_ARRAYTYPECODES = {}
+for code in 'bhilq':
+    try:
+        size = 1 << ((array(code).itemsize << 3) - 1)
+    except ValueError:  # 'q' might not be available
+        pass
+    else:
+        if size not in _ARRAYTYPECODES:
+            _ARRAYTYPECODES[size] = code
+_ARRAYSIZES = list(_ARRAYTYPECODES.keys())
+_ARRAYSIZES.sort()
+_INDEXTYPECODE = _ARRAYTYPECODES[_ARRAYSIZES[-1]]  # widest available
+del size, code
+
+MAXCAPTURES = 100
+MAXRECURSION = 200
+ESCAPE = '%'
+SPECIALS = '^$*+?.([-'
+UNFINISHEDCAPTURE = -1
+POSITIONCAPTURE = -2
+PLACEHOLDER = -3
+
+
+def _ishexdigit(sc):
+    return sc.isdigit() or sc in 'abcdefABCDEF'
+
+
+# Maps each (lowercase) class letter to a predicate taking one character.
+# Uppercase class letters are the complement and are handled by callers.
+_CLASSES = {
+    'a': str.isalpha,
+    'd': str.isdigit,
+    'l': str.islower,
+    's': str.isspace,
+    'u': str.isupper,
+    'w': lambda sc: sc.isalpha() or sc.isdigit(),
+    'x': _ishexdigit,
+    'z': lambda sc: sc == '\0',
+    'c': lambda sc: unicodedata.category(sc)[0] == 'C',
+    'g': lambda sc: unicodedata.category(sc)[0] not in 'CZ',
+    'p': lambda sc: unicodedata.category(sc)[0] == 'P',
+}
+
+
+# The classes as stock Lua sees them in the C locale, for ascii=True: each
+# is the set of ASCII characters in it, and nothing else belongs to any.
+_ASCIICLASSES = {
+    'a': frozenset(string.ascii_letters),
+    'd': frozenset(string.digits),
+    'l': frozenset(string.ascii_lowercase),
+    's': frozenset(' \t\n\v\f\r'),
+    'u': frozenset(string.ascii_uppercase),
+    'w': frozenset(string.ascii_letters + string.digits),
+    'x': frozenset(string.hexdigits),
+    'z': frozenset('\0'),
+    'c': frozenset(map(chr, list(range(32)) + [127])),
+    'g': frozenset(map(chr, range(33, 127))),
+    'p': frozenset(string.punctuation),
+}
+
+
+def _classpredicate(pc, ascii=False):
+    '''Return a predicate for the class letter pc, or None if pc is not one.
+
+    Characters that are not class letters stand for themselves, so callers
+    fall back to a plain comparison in that case.  With ascii, the class is
+    looked up in _ASCIICLASSES instead.
+    '''
+    if ascii:
+        table = _ASCIICLASSES.get(pc.lower())
+        if table is None:
+            return None
+        if pc.islower():
+            return table.__contains__
+        return lambda sc: sc not in table
+    test = _CLASSES.get(pc.lower())
+    if test is None or pc.islower():
+        return test
+    return lambda sc: not test(sc)
+
+
+def _anychar(sc):
+    return True
+
+
+def _casevariants(c):
+    '''Return the single-character case variants of c, c included.'''
+    return {v for v in (c, c.lower(), c.upper()) if len(v) == 1}
+
+
+def _importnumpy(required):
+    '''Return the numpy module, or None if it is not installed.
+
+    NumPy is an optional dependency; ImportError is only propagated when
+    the caller explicitly asked for NumPy output.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        if required:
+            raise
+        return None
+    return numpy
+
+
+class PatternError(Exception):
+    '''Base class for all pattern-related errors in this module.'''
+
+
+class PatternSyntaxError(PatternError):
+    '''All syntax errors; argument is description of problem.'''
+
+
+class PatternLongSourceError(PatternError):
+    def __str__(self):
+        return 'source string too long'
+
+
+class PatternTooComplex(PatternError):
+    '''Base class for when the pattern exceeds complexity limits.'''
+
+
+class PatternStackOverflow(PatternTooComplex):
+    def __str__(self):
+        return 'pattern too complex, exceeded recursion limit'
+
+
+class PatternTooManyCaptures(PatternTooComplex):
+    def __str__(self):
+        return 'too many captures'
+
+
+class ScanError(PatternError):
+    '''No token of a Scanner matches; pos is where scanning stopped.'''
+
+    def __init__(self, pos):
+        super().__init__(pos)
+        self.pos = pos
+
+    def __str__(self):
+        return 'no token matches at position {}'.format(self.pos)
+
+
+class PatternCancelled(PatternError):
+    '''The search was stopped through its CancelToken.'''
+
+    def __str__(self):
+        return 'search cancelled'
+
+
+_cancellation = threading.local()  # token: the CancelToken in effect
+
+
+class CancelToken:
+    '''A flag that stops searches at their next checkpoint once cancel()
+    has been called.
+
+    Searches started in the current thread inside "with token:" check it
+    at every backtracking step and between the searches of gmatch(),
+    gsub() and the like, and raise PatternCancelled once it is set.
+    Generated code cannot be interrupted, so codegen patterns are run by
+    the interpreter while a token is in effect.
+
+    event is the flag, a threading.Event by default; a multiprocessing
+    manager's Event can be passed to cancel work in another process.
+    interval is how many checkpoints pass between looks at a flag that is
+    expensive to query.
+    '''
+
+    def __init__(self, event=None, interval=1):
+        self.event = threading.Event() if event is None else event
+        self.interval = interval
+        self.countdown = interval
+        self.previous = []
+
+    def __enter__(self):
+        self.previous.append(getattr(_cancellation, 'token', None))
+        _cancellation.token = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _cancellation.token = self.previous.pop()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['previous'] = []  # belongs to the thread that entered it
+        return state
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        '''Raise PatternCancelled if the token has been cancelled.'''
+        self.countdown -= 1
+        if self.countdown <= 0:
+            self.countdown = self.interval
+            if self.event.is_set():
+                raise PatternCancelled
+
+
+class _MatchState:
+    def __init__(self, source, pattern, noanchor=False):
+        self.matchdepth = MAXRECURSION
+        self.source = source
+        self.srcstart = 0
+        self.capturenum = 0
+        sourcelen = len(source)
+        for size in _ARRAYSIZES:
+            if sourcelen < size:
+                typecode = _ARRAYTYPECODES[size]
+                break
+        else:
+            raise PatternLongSourceError
+        self.capturestarts = array(typecode, [PLACEHOLDER]) * MAXCAPTURES
+        self.captureends = array(typecode, [PLACEHOLDER]) * MAXCAPTURES
+
+    def reset(self, init):
+        self.capturenum = 0
+        self.srcstart = init
+        self.matchdepth = MAXRECURSION
+
+    def getsinglecapture(self, num):
+        start = self.capturestarts[num]
+        end = self.captureends[num]
+        if end == POSITIONCAPTURE:
+            return start
+        else:
+            return self.source[start:end]
+
+    def getcaptures(self, sp):
+        if self.capturenum == 0:
+            return [self.source[self.srcstart:sp]]
+        else:
+            return [self.getsinglecapture(n) for n
+                    in range(self.capturenum)]
+
+
+class _PatternMatcher:
+    def __init__(self, source, pattern, noanchor=False):
+        self.source = source
+        self.srclen = len(source)
+        self.compiled = pattern
+        self.pattern = pattern = pattern.program
+        self.pattlen = len(pattern)
+        self.escape = self.compiled.escape
+        self.anchor = False if noanchor else (self.pattlen > 0 and
+                                              pattern[0] == '^')
+        self.predicates = self.compiled._predicates
+        self.runs = self.compiled._runs
+        self.ignorecase = self.compiled.ignorecase
+        self.ascii = self.compiled.ascii
+        self.indexed = source if isinstance(source, Source) else None
+        if self.indexed is not None:
+            self.balances = source._balances  # shared with other patterns
+        else:
+            self.balances = {}
+        self.frontierblock = (0, b'')  # (start, mask), see nextfrontier()
+        self.state = None
+
+    @property
+    def nospecials(self):
+        return self.compiled.nospecials
+
+    def find_aux(self, type, init=0, plain=False, laststart=None,
+                 anchored=False):
+        # With anchored, only a match starting exactly at init is found,
+        # whether or not the pattern starts with '^'.
+        if init < 0:
+            init = 0
+        if init > self.srclen:  # start after source's end?
+            return None  # no chance of finding anything
+        if type == 'find' and (plain or self.nospecials):
+            text = self.compiled.pattern  # the pattern as given
+            start = self.source.find(text, init)  # built-in str.find()
+            if start > -1 and not (anchored and start != init):
+                return (start, start + len(text))
+        else:
+            pp = 1 if self.anchor else 0
+            minimum, maximum, endanchored = self.compiled._getbounds(pp)
+            last = self.srclen - minimum  # later starts are too close to end
+            if laststart is not None:
+                last = min(last, laststart)
+            if endanchored and maximum is not None and not self.anchor:
+                if anchored and init < self.srclen - maximum:
+                    return None
+                init = max(init, self.srclen - maximum)
+            if init > last:
+                return None
+            init -= 1
+            if self.state is None:  # reused by every search on this source
+                self.state = _MatchState(self.source, self.pattern)
+            starts = None
+            if not (self.anchor or anchored):
+                starts = self.startfinder(pp)
+            first = True
+            while first or ((self.state.srcstart < last) and
+                            not self.anchor and not anchored):
+                first = False
+                init += 1
+                if starts is not None:  # jump to the next possible start
+                    init = starts(init, last + 1)
+                    if init < 0:
+                        return None
+                self.state.reset(init)
+                sp = self.match(init, pp)
+                if sp is not None:
+                    if type == 'span':  # no captures wanted
+                        return init, sp
+                    elif type == 'find':
+                        ret = [init, sp]
+                        if self.state.capturenum != 0:
+                            ret.extend(self.state.getcaptures(sp))
+                        return tuple(ret)
+                    elif type == 'match':
+                        result = tuple(self.state.getcaptures(sp))
+                        if len(result) == 1:
+                            return result[0]
+                        else:
+                            return result
+                    elif type == 'gmatch':
+                        captures = tuple(self.state.getcaptures(sp))
+                        if len(captures) == 1:
+                            return (init, sp), captures[0]
+                        else:
+                            return (init, sp), captures
+                    elif type == 'gsub':
+                        return (init, sp), tuple(self.state.getcaptures(sp))
+        return None
+
+    def startfinder(self, pp):
+        '''Return a function (pos, stop) giving the first position in
+        pos..stop-1 where a match could start, or -1, for patterns whose
+        first item rules most positions out; otherwise None.'''
+        item = self.compiled._startitem(pp)
+        if item is None:
+            return None
+        kind, arg, quant = item
+        if self.indexed is not None:
+            if kind in ('char', 'class', 'set') and quant in (None, '+'):
+                mask = self.indexed._mask(kind, arg, self.escape,
+                                          self.ignorecase, self.ascii)
+            elif kind == 'frontier':
+                mask = self.indexed._frontiers(arg, self.escape,
+                                               self.ignorecase, self.ascii)
+            elif kind == 'balance':  # the opener is compared exactly
+                mask = self.indexed._mask('char', arg[0], self.escape)
+            else:
+                return None
+            return lambda pos, stop: mask.find(1, pos, stop)
+        elif kind == 'frontier':
+            self.frontiertest = self.compiled._frontiertest(pp)
+            return self.nextfrontier
+        return None
+
+    def nextfrontier(self, pos, stop):
+        '''Return the first position in pos..stop-1 where the starting %f
+        holds, or -1.  Frontier masks are computed a block at a time and
+        the last one is kept for the following searches.'''
+        start, mask = self.frontierblock
+        while pos < stop:
+            if not start <= pos < start + len(mask):
+                start = pos
+                end = min(pos + _FRONTIERBLOCK, self.srclen + 1)
+                mask = _frontiermask(self.source, start, end,
+                                     self.frontiertest)
+                self.frontierblock = (start, mask)
+            found = mask.find(1, pos - start, stop - start)
+            if found >= 0:
+                return start + found
+            pos = start + len(mask)
+        return -1
+
+    def rfind_aux(self):
+        '''Return what find() would for the rightmost start position that
+        matches, trying start positions from the end backwards.'''
+        pp = 1 if self.anchor else 0
+        minimum, maximum, endanchored = self.compiled._getbounds(pp)
+        start = self.srclen - minimum  # later starts are too close to end
+        first = 0
+        if self.anchor:
+            start = min(start, 0)
+        elif endanchored and maximum is not None:
+            first = max(first, self.srclen - maximum)
+        prefix = '' if self.ignorecase else self.compiled._prefix(pp)
+        if self.state is None:
+            self.state = _MatchState(self.source, self.pattern)
+        while start >= first:
+            if prefix:  # only starts where the prefix occurs can match
+                start = self.source.rfind(prefix, first, start + len(prefix))
+                if start < 0:
+                    return None
+            self.state.reset(start)
+            sp = self.match(start, pp)
+            if sp is not None:
+                ret = [start, sp]
+                if self.state.capturenum != 0:
+                    ret.extend(self.state.getcaptures(sp))
+                return tuple(ret)
+            start -= 1
+        return None
+
+    def _subst_str(self, captures, repl, matchstart, matchend):
+        char = 0
+        rlen = len(repl)
+        accum = []
+        while char < rlen:
+            c = repl[char]
+            if c != self.escape:
+                accum.append(c)
+            else:
+                char += 1
+                if char == rlen:
+                    raise PatternSyntaxError(
+                        "replacement string ends with bare '{}'".format(
+                            self.escape)
+                    )
+                c = repl[char]
+                if c == self.escape:
+                    accum.append(self.escape)
+                elif c in '123456789':
+                    if c == '1':
+                        c = 0
+                    else:
+                        c = self.checkcapture(int(c))
+                    accum.append(str(captures[c]))
+                elif c == '0':
+                    accum.append(
+                        str(self.source[matchstart:matchend])
+                    )
+                else:
+                    raise PatternSyntaxError(
+                        "invalid '{}{}' in replacement "
+                        "string".format(self.escape, c)
+                    )
+            char += 1
+        return ''.join(accum)
+
+    def subst(self, captures, repl, matchstart, matchend):
+        if callable(repl):
+            value = repl(*captures)
+        elif isinstance(repl, Mapping):
+            value = repl.get(captures[0])
+        else:
+            value = self._subst_str(captures, str(repl), matchstart, matchend)
+        if value is None or value is False:
+            value = self.source[matchstart:matchend]
+        return str(value)
+
+    def match(self, sp, pp):
+        if self.state.matchdepth == 0:
+            raise PatternStackOverflow
+        self.state.matchdepth -= 1
+        while pp < self.pattlen:
+            pc = self.pattern[pp]
+            try:
+                pc1 = self.pattern[pp + 1]
+            except IndexError:
+                pc1 = None
+            if pc == '(':
+                if pc1 == ')':
+                    sp = self.startcapture(sp, pp + 2, POSITIONCAPTURE)
+                else:
+                    sp = self.startcapture(sp, pp + 1, UNFINISHEDCAPTURE)
+                break
+            elif pc == ')':
+                sp = self.endcapture(sp, pp + 1)
+                break
+            elif pc == '$' and pp + 1 == self.pattlen:
+                if sp != self.srclen:
+                    sp = None
+                break
+            elif pc == self.escape:
+                if pc1 is None:
+                    raise PatternSyntaxError(
+                        "pattern ends with bare '{}'".format(self.escape)
+                    )
+                elif pc1 == 'b':
+                    sp = self.matchbalance(sp, pp + 2)
+                    if sp is None:
+                        break
+                    pp += 4
+                    continue
+                elif pc1 == 'f':
+                    pp += 2
+                    if pp >= self.pattlen or self.pattern[pp] != '[':
+                        raise PatternSyntaxError(
+                            "missing '[' after '{}f'".format(self.escape)
+                        )
+                    ep = self.classend(pp)
+                    if self.indexed is not None and sp < self.srclen:
+                        frontier = self.indexed._frontiers(
+                            self.pattern[pp + 1:ep - 1], self.escape,
+                            self.ignorecase, self.ascii
+                        )[sp]
+                    else:
+                        test = self.itempredicate(pp, ep)
+                        prev = '\0' if sp == 0 else self.source[sp - 1]
+                        next = '\0' if sp >= self.srclen else self.source[sp]
+                        frontier = not test(prev) and test(next)
+                    if frontier:
+                        pp = ep
+                        continue
+                    sp = None
+                    break
+                elif pc1 in '0123456789':
+                    sp = self.matchcapture(sp, int(pc1))
+                    if sp is None:
+                        break
+                    pp += 2
+                    continue
+            # This point can only be reached if all conditions above test
+            # false. Any true condition above is guaranteed to result in
+            # either a break, a continue, or raising an error.
+            run = self.literalrun(pp)
+            if run is not None:  # compare several literals at once
+                text, ep = run
+                if not self.source.startswith(text, sp, self.srclen):
+                    sp = None
+                    break
+                sp += len(text)
+                pp = ep
+                continue
+            ep = self.classend(pp)  # ep points to the optional quantifier
+            try:
+                qc = self.pattern[ep]
+            except IndexError:
+                qc = None
+            if not self.singlematch(sp, pp, ep):
+                if qc and qc in '*?-':  # allow zero matches?
+                    pp = ep + 1
+                    continue
+                sp = None
+                break
+            else:  # matched once
+                if qc == '?':
+                    result = self.match(sp + 1, ep + 1)
+                    if result is None:
+                        pp = ep + 1
+                        continue
+                    else:
+                        sp = result
+                        break
+                elif qc == '+':
+                    sp = self.maxexpand(sp + 1, pp, ep)
+                    break
+                elif qc == '*':
+                    sp = self.maxexpand(sp, pp, ep)
+                    break
+                elif qc == '-':
+                    sp = self.minexpand(sp, pp, ep)
+                    break
+                else:  # no quantifier
+                    sp += 1
+                    pp = ep
+                    continue
+        self.state.matchdepth += 1
+        return sp
+
+    def matchcapture(self, sp, num):
+        index = self.checkcapture(num)
+        cs = self.state.capturestarts[index]
+        ce = self.state.captureends[index]
+        cl = ce - cs
+        if cl > self.srclen - sp:
+            return None
+        text = self.source[sp:sp + cl]
+        capture = self.state.getsinglecapture(index)
+        if text == capture or (self.ignorecase and isinstance(capture, str) and
+                               text.lower() == capture.lower()):
+            return sp + cl
+        else:
+            return None
+
+    def startcapture(self, sp, pp, what):
+        cnum = self.state.capturenum
+        if cnum >= MAXCAPTURES:
+            raise PatternTooManyCaptures
+        self.state.capturestarts[cnum] = sp
+        self.state.captureends[cnum] = what
+        self.state.capturenum += 1
+        result = self.match(sp, pp)
+        if result is None:
+            self.state.capturenum -= 1
+        elif self.state.captureends[cnum] == UNFINISHEDCAPTURE:
+            raise PatternSyntaxError('unfinished capture')
+        return result
+
+    def endcapture(self, sp, pp):
+        index = self.capturetoclose()
+        self.state.captureends[index] = sp
+        result = self.match(sp, pp)
+        if result is None:
+            self.state.captureends[index] = UNFINISHEDCAPTURE
+        return result
+
+    def literalrun(self, pp):
+        '''Return (text, ep) for the run of two or more unquantified literal
+        characters at pp, where ep is the pattern position after it, or
+        None if there is no such run.'''
+        try:
+            return self.runs[pp]
+        except KeyError:
+            pass
+        chars = []
+        ep = pp
+        while not self.ignorecase and ep < self.pattlen:
+            pc = self.pattern[ep]
+            if pc == self.escape:
+                pc = self.pattern[ep + 1:ep + 2]
+                if not pc or pc.isalnum():
+                    break  # a class, %b, %f or a back-reference
+                width = 2
+            elif pc in SPECIALS or pc in '()':
+                break
+            else:
+                width = 1
+            if self.pattern[ep + width:ep + width + 1] in ('*', '+', '-', '?'):
+                break  # quantified, so not a plain comparison
+            chars.append(pc)
+            ep += width
+        run = (''.join(chars), ep) if len(chars) > 1 else None
+        self.runs[pp] = run
+        return run
+
+    def nextliteral(self, ep):
+        '''Return the literal character that must follow the item ending at
+        ep, or None if the next item is not a mandatory literal.'''
+        pp = ep + 1
+        if pp >= self.pattlen or self.ignorecase:
+            return None
+        pc = self.pattern[pp]
+        if pc in SPECIALS or pc in self.escape + ')':
+            return None
+        if pp + 1 < self.pattlen and self.pattern[pp + 1] in '*?-':
+            return None
+        return pc
+
+    def itemrun(self, sp, pp, ep, limit=None):
+        '''Count how many consecutive characters from sp match the item.'''
+        stop = self.srclen if limit is None else min(limit, self.srclen)
+        pc = self.pattern[pp]
+        if pc == '.':
+            return max(stop - sp, 0)
+        source = self.source
+        if pc not in SPECIALS and pc != self.escape and not self.ignorecase:
+            # Literal: gallop with str.startswith() over growing blocks
+            end = sp
+            size = 1
+            while size:
+                if end + size <= stop and source.startswith(pc * size, end):
+                    end += size
+                    if size < 4096:
+                        size <<= 1
+                else:
+                    size >>= 1
+            return end - sp
+        if self.indexed is not None:  # find the first non-matching char
+            kind, arg = self.itemkind(pp, ep)
+            mask = self.indexed._mask(kind, arg, self.escape,
+                                      self.ignorecase, self.ascii)
+            end = mask.find(0, sp, stop)
+            return (stop if end < 0 else end) - sp
+        predicate = self.itempredicate(pp, ep)
+        end = sp
+        while end < stop and predicate(source[end]):
+            end += 1
+        return end - sp
+
+    def minexpand(self, sp, pp, ep):
+        literal = self.nextliteral(ep)
+        if literal is not None:
+            # Only positions holding the next literal can possibly succeed
+            anychar = self.pattern[pp] == '.'
+            while True:
+                pos = self.source.find(literal, sp, self.srclen)
+                if pos < 0:
+                    return None
+                if not anychar and self.itemrun(sp, pp, ep, pos) < pos - sp:
+                    return None
+                result = self.match(pos, ep + 1)
+                if result is not None:
+                    return result
+                elif self.singlematch(pos, pp, ep):
+                    sp = pos + 1
+                else:
+                    return None
+        while True:
+            result = self.match(sp, ep + 1)
+            if result is not None:
+                return result
+            elif self.singlematch(sp, pp, ep):
+                sp += 1
+            else:
+                return None
+
+    def maxexpand(self, sp, pp, ep):
+        count = self.itemrun(sp, pp, ep)
+        literal = self.nextliteral(ep)
+        if literal is not None:
+            # Only positions holding the next literal can possibly succeed
+            end = sp + count + 1
+            while True:
+                pos = self.source.rfind(literal, sp, end)
+                if pos < 0:
+                    return None
+                result = self.match(pos, ep + 1)
+                if result is not None:
+                    return result
+                end = pos
+        while count >= 0:
+            result = self.match(sp + count, ep + 1)
+            if result is not None:
+                return result
+            count -= 1
+        return None
+
+    def matchbalance(self, sp, pp):
+        if pp > self.pattlen - 2:
+            raise PatternSyntaxError(
+                "missing arguments to '{}b')".format(self.escape)
+            )
+        return self.balanceend(sp, self.pattern[pp], self.pattern[pp + 1])
+
+    def balanceend(self, sp, b, e):
+        if sp == self.srclen or self.source[sp] != b:
+            return None
+        if e == b:
+            end = self.source.find(e, sp + 1, self.srclen)
+            return None if end < 0 else end + 1
+        ends = self.balances.setdefault(b + e, {})
+        try:
+            end = ends[sp]
+        except KeyError:
+            end = self.scanbalance(sp, b, e, ends)
+        if end is not None and end > self.srclen:
+            return None  # closes past the end given to rfind()
+        return end
+
+    def scanbalance(self, sp, b, e, ends):
+        '''Find the end of the balanced span opened at sp.
+
+        The scan jumps between delimiters with str.find() and records the
+        outcome for every nested opener it passes in ends (end position, or
+        None if it is never closed), so later starts inside the same region
+        are answered without scanning it again.
+        '''
+        source = self.source
+        find = source.find
+        stack = [sp]
+        nextb = find(b, sp + 1)
+        nexte = find(e, sp + 1)
+        while stack:
+            if nexte < 0:
+                break  # no closers left, so every open span fails
+            if 0 <= nextb < nexte:
+                known = ends.get(nextb, False)
+                if known is None:
+                    break  # nested span never closes, so neither do we
+                elif known is False:
+                    stack.append(nextb)
+                    nextb = find(b, nextb + 1)
+                else:  # skip over a span already known to be balanced
+                    nextb = find(b, known)
+                    nexte = find(e, known)
+            else:
+                ends[stack.pop()] = nexte + 1
+                nexte = find(e, nexte + 1)
+        for opener in stack:
+            ends[opener] = None
+        return ends[sp]
+
+    def singlematch(self, sp, pp, ep):
+        if sp >= self.srclen:
+            return False
+        return self.itempredicate(pp, ep)(self.source[sp])
+
+    def itemkind(self, pp, ep):
+        '''Return (kind, arg) for the single-char item at pp..ep, as in
+        _parse().'''
+        pc = self.pattern[pp]
+        if pc == '.':
+            return 'any', None
+        elif pc == self.escape:
+            arg = self.pattern[pp + 1]
+            return 'class' if arg.lower() in _CLASSES else 'char', arg
+        elif pc == '[':
+            return 'set', self.pattern[pp + 1:ep - 1]
+        return 'char', pc
+
+    def itempredicate(self, pp, ep):
+        '''Return a cached predicate for the single-char item at pp..ep.'''
+        try:
+            return self.predicates[pp]
+        except KeyError:
+            pass
+        kind, arg = self.itemkind(pp, ep)
+        predicate = _itempredicate(kind, arg, self.escape, self.ignorecase,
+                                   self.ascii)
+        self.predicates[pp] = predicate
+        return predicate
+
+    def checkcapture(self, n):
+        n -= 1
+        if (n < 0 or n >= self.state.capturenum or
+                self.state.captureends[n] == UNFINISHEDCAPTURE):
+            raise PatternSyntaxError(
+                'invalid capture index {}{}'.format(self.escape, n + 1)
+            )
+        return n
+
+    def capturetoclose(self):
+        for index in range(self.state.capturenum - 1, -1, -1):
+            if self.state.captureends[index] == UNFINISHEDCAPTURE:
+                return index
+        raise PatternSyntaxError("unmatched ')'")
+
+    def classend(self, pp):
+        return _classend(self.pattern, pp, self.escape)
+
+
+def _classend(pattern, pp, escape):
+    pc = pattern[pp]
+    pp += 1
+    if pc == escape:
+        # The error case of a pattern ending with a bare escape is handled
+        # in _PatternMatcher.match() before this is ever called.
+        return pp + 1
+    elif pc == '[':
+        try:
+            if pattern[pp] == '^':
+                pp += 1
+            if pattern[pp] == ']':
+                pp += 1
+            while pattern[pp] != ']':
+                if (pattern[pp] == escape and
+                        pp + 1 < len(pattern)):
+                    pp += 2
+                else:
+                    pp += 1
+            return pp + 1
+        except IndexError:
+            raise PatternSyntaxError("missing ']'") from None
+    else:
+        return pp
+
+
+def _parseset(set, escape):
+    '''Split the body of a bracket class into its parts.
+
+    Returns (signal, chars, ranges, letters): whether a member matches (False
+    for a negated set), the literal characters, the (low, high) ranges, and
+    the class letters, each of the latter as accepted by _classpredicate().
+    '''
+    if set[0] == '^':
+        signal = False
+        pos = 1
+    else:
+        signal = True
+        pos = 0
+    chars = []
+    ranges = []
+    letters = []
+    sl = len(set)
+    while pos < sl:
+        pc = set[pos]
+        try:
+            pc1 = set[pos + 1]
+        except IndexError:
+            pc1 = None
+        if pc == escape:
+            pos += 1
+            if pc1.lower() in _CLASSES:
+                letters.append(pc1)
+            else:
+                chars.append(pc1)
+        elif pc1 == '-' and pos + 2 < sl:
+            pos += 2
+            ranges.append((pc, set[pos]))
+        else:
+            chars.append(pc)
+        pos += 1
+    return signal, chars, ranges, letters
+
+
+def _compileset(set, escape, ignorecase=False, ascii=False):
+    '''Compile the body of a bracket class into a single predicate.
+
+    With ignorecase, literal characters and ranges also match the other
+    case; classes are not affected.  With ascii, classes use the ASCII
+    tables.
+    '''
+    signal, chars, ranges, letters = _parseset(set, escape)
+    classes = [_classpredicate(letter, ascii) for letter in letters]
+    if ignorecase:
+        chars = [variant for c in chars for variant in _casevariants(c)]
+        candidates = _casevariants
+    else:
+        def candidates(sc):
+            return (sc,)
+    chars = frozenset(chars)
+    memo = {}
+
+    def predicate(sc):
+        try:
+            return memo[sc]
+        except KeyError:
+            pass
+        if (sc in chars or
+                any(lo <= c <= hi for c in candidates(sc)
+                    for lo, hi in ranges) or
+                any(test(sc) for test in classes)):
+            result = signal
+        else:
+            result = not signal
+        memo[sc] = result
+        return result
+    return predicate
+
+
+def _itempredicate(kind, arg, escape, ignorecase=False, ascii=False):
+    '''Return a predicate for a parsed single-char item.'''
+    if kind == 'any':
+        return _anychar
+    elif kind == 'class':
+        return _classpredicate(arg, ascii)
+    elif kind == 'set':
+        return _compileset(arg, escape, ignorecase, ascii)
+    elif ignorecase:
+        return frozenset(_casevariants(arg)).__contains__
+    else:
+        return arg.__eq__
+
+
+def _parse(pattern, escape, pp=0):
+    '''Parse pattern, starting at pp, into a list of items.
+
+    Each item is a (kind, arg, quantifier) tuple.  A problem that the matcher
+    would only report on reaching it becomes a final 'error' item holding the
+    exception, so that compiled code raises at the same point the
+    interpreter does.
+    '''
+    items = []
+    pattlen = len(pattern)
+    opened = 0
+    while pp < pattlen:
+        pc = pattern[pp]
+        pc1 = pattern[pp + 1] if pp + 1 < pattlen else None
+        if pc == '(':
+            if opened >= MAXCAPTURES:
+                items.append(('error', PatternTooManyCaptures(), None))
+                break
+            opened += 1
+            if pc1 == ')':
+                items.append(('position', None, None))
+                pp += 2
+            else:
+                items.append(('open', None, None))
+                pp += 1
+            continue
+        elif pc == ')':
+            items.append(('close', None, None))
+            pp += 1
+            continue
+        elif pc == '$' and pp + 1 == pattlen:
+            items.append(('end', None, None))
+            break
+        elif pc == escape:
+            if pc1 is None:
+                items.append(('error', PatternSyntaxError(
+                    "pattern ends with bare '{}'".format(escape)
+                ), None))
+                break
+            elif pc1 == 'b':
+                if pp + 2 > pattlen - 2:
+                    items.append(('error', PatternSyntaxError(
+                        "missing arguments to '{}b')".format(escape)
+                    ), None))
+                    break
+                items.append(('balance', pattern[pp + 2:pp + 4], None))
+                pp += 4
+                continue
+            elif pc1 == 'f':
+                pp += 2
+                try:
+                    if pp >= pattlen or pattern[pp] != '[':
+                        raise PatternSyntaxError(
+                            "missing '[' after '{}f'".format(escape)
+                        )
+                    ep = _classend(pattern, pp, escape)
+                except PatternSyntaxError as e:
+                    items.append(('error', e, None))
+                    break
+                items.append(('frontier', pattern[pp + 1:ep - 1], None))
+                pp = ep
+                continue
+            elif pc1 in '0123456789':
+                items.append(('backref', int(pc1), None))
+                pp += 2
+                continue
+        try:
+            ep = _classend(pattern, pp, escape)
+        except PatternSyntaxError as e:
+            items.append(('error', e, None))
+            break
+        if pc == '.':
+            item = ('any', None)
+        elif pc == escape:
+            item = ('class' if pc1.lower() in _CLASSES else 'char', pc1)
+        elif pc == '[':
+            item = ('set', pattern[pp + 1:ep - 1])
+        else:
+            item = ('char', pc)
+        if ep < pattlen and pattern[ep] in '*+-?':
+            items.append(item + (pattern[ep],))
+            pp = ep + 1
+        else:
+            items.append(item + (None,))
+            pp = ep
+    return items
+
+
+# Adjacent greedy repetitions of one item that together repeat it like a
+# single quantifier; None stands for exactly once.
+_MERGEDQUANTIFIERS = {
+    (None, '*'): '+',
+    ('*', None): '+',
+    ('+', '*'): '+',
+    ('*', '+'): '+',
+    ('*', '*'): '*',
+}
+
+
+def _optimize(items, escape):
+    '''Return items rewritten into an equivalent, cheaper form.
+
+    Single-member sets become plain items, adjacent greedy repetitions of
+    one item are merged (x x* -> x+), and a lazy item that can only be
+    followed by $ is made greedy (.-$ -> .*$).  Items that raise an error
+    are left alone, along with everything else in the pattern.
+    '''
+    if any(kind == 'error' for kind, arg, quant in items):
+        return items
+    optimized = []
+    for kind, arg, quant in items:
+        if kind == 'set':
+            signal, chars, ranges, letters = _parseset(arg, escape)
+            if signal and not ranges:
+                if len(set(chars)) == 1 and not letters:
+                    kind, arg = 'char', chars[0]
+                elif not chars and len(letters) == 1:
+                    kind, arg = 'class', letters[0]
+        if optimized:
+            lastkind, lastarg, lastquant = optimized[-1]
+            merged = _MERGEDQUANTIFIERS.get((lastquant, quant))
+            if (merged is not None and (lastkind, lastarg) == (kind, arg) and
+                    kind in ('any', 'char', 'class', 'set')):
+                optimized[-1] = (kind, arg, merged)
+                continue
+        optimized.append((kind, arg, quant))
+    if optimized and optimized[-1][0] == 'end':
+        index = len(optimized) - 2
+        while index >= 0 and optimized[index][0] in ('close', 'position'):
+            index -= 1
+        if index >= 0 and optimized[index][2] == '-':
+            kind, arg, quant = optimized[index]
+            optimized[index] = (kind, arg, '*')
+    return optimized
+
+
+def _unparse(items, escape):
+    '''Return pattern text that parses back into items.'''
+    pieces = []
+    for kind, arg, quant in items:
+        if kind == 'any':
+            piece = '.'
+        elif kind == 'char':
+            if arg == escape or arg in SPECIALS + ')$':
+                piece = escape + arg
+            else:
+                piece = arg
+        elif kind == 'class':
+            piece = escape + arg
+        elif kind == 'set':
+            piece = '[' + arg + ']'
+        elif kind == 'open':
+            piece = '('
+        elif kind == 'position':
+            piece = '()'
+        elif kind == 'close':
+            piece = ')'
+        elif kind == 'end':
+            piece = '$'
+        elif kind == 'balance':
+            piece = escape + 'b' + arg
+        elif kind == 'frontier':
+            piece = escape + 'f[' + arg + ']'
+        else:  # backref
+            piece = escape + str(arg)
+        pieces.append(piece + (quant or ''))
+    return ''.join(pieces)
+
+
+def _literalruns(items):
+    '''Group runs of two or more unquantified literal characters together.
+
+    Yields ('literal', text, None) for each run and passes every other
+    item through unchanged.
+    '''
+    run = []
+    for item in items:
+        if item[0] == 'char' and item[2] is None:
+            run.append(item[1])
+            continue
+        if len(run) > 1:
+            yield 'literal', ''.join(run), None
+        else:
+            for c in run:
+                yield 'char', c, None
+        run = []
+        yield item
+    if len(run) > 1:
+        yield 'literal', ''.join(run), None
+    else:
+        for c in run:
+            yield 'char', c, None
+
+
+def _lengths(items):
+    '''Return (minimum, maximum, endanchored) for parsed items.
+
+    minimum and maximum bound the length of any match; maximum is None when
+    it is unbounded.  An item that raises an error ends the analysis, since
+    nothing after it can take part in a match.
+    '''
+    minimum = maximum = 0
+    stack = []
+    captures = {}
+    for kind, arg, quant in items:
+        if kind in ('any', 'char', 'class', 'set'):
+            low, high = {None: (1, 1), '?': (0, 1), '+': (1, None),
+                         '*': (0, None), '-': (0, None)}[quant]
+        elif kind == 'balance':
+            low, high = 2, None
+        elif kind == 'backref' and arg - 1 in captures:
+            low, high = captures[arg - 1]
+        elif kind == 'open':
+            stack.append((len(captures) + len(stack), minimum, maximum))
+            low = high = 0
+        elif kind == 'close' and stack:
+            num, startmin, startmax = stack.pop()
+            captures[num] = (minimum - startmin, None if maximum is None
+                             else maximum - startmax)
+            low = high = 0
+        elif kind in ('position', 'end', 'frontier'):
+            if kind == 'position':
+                captures[len(captures) + len(stack)] = (0, None)
+            low = high = 0
+        else:  # errors, unmatched ')' and invalid back-references
+            maximum = None
+            break
+        minimum += low
+        if maximum is not None:
+            maximum = None if high is None else maximum + high
+    endanchored = bool(items) and items[-1][0] == 'end'
+    return minimum, maximum, endanchored
+
+
+_CLASSEXPRS = {
+    'a': '{0}.isalpha()',
+    'd': '{0}.isdigit()',
+    'l': '{0}.islower()',
+    's': '{0}.isspace()',
+    'u': '{0}.isupper()',
+    'w': '({0}.isalpha() or {0}.isdigit())',
+    'x': "({0}.isdigit() or {0} in 'abcdefABCDEF')",
+    'z': "{0} == '\\0'",
+    'c': "_category({0})[0] == 'C'",
+    'g': "_category({0})[0] not in 'CZ'",
+    'p': "_category({0})[0] == 'P'",
+}
+
+
+class _CodeGenerator:
+    '''Translate parsed items into the source of a matcher factory.
+
+    The generated module defines _factory(s, n, cs, ce, balanceend), which
+    returns the entry function m0(sp).  Items that never backtrack become
+    straight-line code; every quantified item starts a new function that
+    calls the one for the rest of the pattern, much like the recursion in
+    _PatternMatcher.match().
+    '''
+
+    def __init__(self, items, escape, ignorecase=False, ascii=False):
+        self.items = items
+        self.escape = escape
+        self.ignorecase = ignorecase
+        self.ascii = ascii
+        self.lines = ['def _factory(s, n, cs, ce, balanceend):']
+        self.captures = []  # capture index -> is it a position capture?
+        self.pending = [0]
+        self.done = set()
+        self.states = self.capturestates()
+
+    def capturestates(self):
+        # Captures are numbered statically, so the state the interpreter
+        # would track at run time is known for every item up front.
+        states = []
+        stack = []
+        for kind, arg, quant in self.items:
+            states.append((len(self.captures), tuple(stack)))
+            if kind in ('open', 'position'):
+                if kind == 'open':
+                    stack.append(len(self.captures))
+                self.captures.append(kind == 'position')
+            elif kind == 'close' and stack:
+                stack.pop()
+        states.append((len(self.captures), tuple(stack)))
+        return states
+
+    def generate(self):
+        while self.pending:
+            start = self.pending.pop()
+            if start not in self.done:
+                self.done.add(start)
+                self.function(start)
+        self.lines.append('    return m0')
+        return '\n'.join(self.lines) + '\n'
+
+    def emit(self, line):
+        self.lines.append('        ' + line)
+
+    def itemexpr(self, kind, arg, var):
+        if kind == 'any':
+            return 'True'
+        elif kind == 'char':
+            if self.ignorecase:
+                return '{} in {!r}'.format(
+                    var, ''.join(sorted(_casevariants(arg))))
+            return '{} == {!r}'.format(var, arg)
+        elif kind == 'class':
+            return self.classexpr(arg, var)
+        signal, chars, ranges, letters = _parseset(arg, self.escape)
+        if self.ignorecase:
+            chars = [variant for c in chars for variant in _casevariants(c)]
+        tests = []
+        if chars:
+            tests.append('{} in {!r}'.format(var, ''.join(sorted(set(chars)))))
+        for lo, hi in ranges:
+            if self.ignorecase:
+                tests.append('any({!r} <= v <= {!r} '
+                             'for v in _casevariants({}))'.format(lo, hi, var))
+            else:
+                tests.append('{!r} <= {} <= {!r}'.format(lo, var, hi))
+        for letter in letters:
+            tests.append(self.classexpr(letter, var))
+        expr = ' or '.join(tests) or 'False'
+        return '({})'.format(expr) if signal else 'not ({})'.format(expr)
+
+    def classexpr(self, letter, var):
+        if self.ascii:
+            table = '_ascii{}'.format(letter.lower())
+            if letter.islower():
+                return '{} in {}'.format(var, table)
+            return '{} not in {}'.format(var, table)
+        expr = _CLASSEXPRS[letter.lower()].format(var)
+        return expr if letter.islower() else 'not {}'.format(expr)
+
+    def function(self, index):
+        self.lines.append('    def m{}(sp):'.format(index))
+        while index < len(self.items):
+            kind, arg, quant = self.items[index]
+            if quant is not None:
+                self.quantified(index, kind, arg, quant)
+                return
+            text = self.literalrun(index)
+            if len(text) > 1:  # one comparison for the whole run
+                # (the first character is tested inline, as most attempts
+                # fail there and a method call costs more than indexing)
+                self.emit('if (sp >= n or s[sp] != {!r} or'.format(text[0]))
+                self.emit('        not s.startswith({!r}, sp)):'.format(text))
+                self.emit('    return None')
+                self.emit('sp += {}'.format(len(text)))
+                index += len(text)
+                continue
+            if not self.straight(index, kind, arg):
+                return  # the item always raises; nothing after it runs
+            index += 1
+        if self.states[index][1]:
+            self.emit("raise PatternSyntaxError('unfinished capture')")
+        else:
+            self.emit('return sp')
+
+    def literalrun(self, index):
+        # The text of the unquantified literal characters starting at index
+        chars = []
+        while not self.ignorecase and index < len(self.items):
+            kind, arg, quant = self.items[index]
+            if kind != 'char' or quant is not None:
+                break
+            chars.append(arg)
+            index += 1
+        return ''.join(chars)
+
+    def straight(self, index, kind, arg):
+        emit = self.emit
+        capturenum, stack = self.states[index]
+        if kind == 'any':
+            emit('if sp >= n:')
+            emit('    return None')
+            emit('sp += 1')
+        elif kind in ('char', 'class', 'set'):
+            emit('if sp >= n:')
+            emit('    return None')
+            emit('c = s[sp]')
+            emit('if not ({}):'.format(self.itemexpr(kind, arg, 'c')))
+            emit('    return None')
+            emit('sp += 1')
+        elif kind == 'open':
+            emit('cs[{}] = sp'.format(capturenum))
+        elif kind == 'position':
+            emit('cs[{}] = sp'.format(capturenum))
+            emit('ce[{}] = {}'.format(capturenum, POSITIONCAPTURE))
+        elif kind == 'close':
+            if not stack:
+                emit('raise PatternSyntaxError("unmatched \')\'")')
+                return False
+            emit('ce[{}] = sp'.format(stack[-1]))
+        elif kind == 'end':
+            emit('if sp != n:')
+            emit('    return None')
+        elif kind == 'balance':
+            emit('sp = balanceend(sp, {!r}, {!r})'.format(arg[0], arg[1]))
+            emit('if sp is None:')
+            emit('    return None')
+        elif kind == 'frontier':
+            emit("c = s[sp - 1] if sp else '\\0'")
+            emit('if {}:'.format(self.itemexpr('set', arg, 'c')))
+            emit('    return None')
+            emit("c = s[sp] if sp < n else '\\0'")
+            emit('if not {}:'.format(self.itemexpr('set', arg, 'c')))
+            emit('    return None')
+        elif kind == 'backref':
+            num = arg - 1
+            if num < 0 or num >= capturenum or num in stack:
+                emit('raise PatternSyntaxError({!r})'.format(
+                    'invalid capture index {}{}'.format(self.escape, arg)
+                ))
+                return False
+            if self.captures[num]:
+                emit('return None')  # a position never equals a substring
+                return False
+            emit('c = s[cs[{0}]:ce[{0}]]'.format(num))
+            if self.ignorecase:
+                emit('if (len(c) > n - sp or')
+                emit('        s[sp:sp + len(c)].lower() != c.lower()):')
+            else:
+                emit('if not s.startswith(c, sp):')
+            emit('    return None')
+            emit('sp += len(c)')
+        elif kind == 'error':
+            emit('raise {}{!r}'.format(type(arg).__name__, arg.args))
+            return False
+        return True
+
+    def nextliteral(self, index):
+        if self.ignorecase:
+            return None  # str.find() and str.rfind() are case-sensitive
+        try:
+            kind, arg, quant = self.items[index]
+        except IndexError:
+            return None
+        if kind == 'char' and quant in (None, '+'):
+            return arg
+        return None
+
+    def quantified(self, index, kind, arg, quant):
+        emit = self.emit
+        rest = 'm{}'.format(index + 1)
+        self.pending.append(index + 1)
+        test = self.itemexpr(kind, arg, 'c')
+        if quant == '?':
+            emit('if sp < n:')
+            emit('    c = s[sp]')
+            emit('    if {}:'.format(test))
+            emit('        r = {}(sp + 1)'.format(rest))
+            emit('        if r is not None:')
+            emit('            return r')
+            emit('return {}(sp)'.format(rest))
+            return
+        literal = self.nextliteral(index + 1)
+        if quant == '-':
+            emit('while True:')
+            if literal is not None:
+                emit('    e = s.find({!r}, sp)'.format(literal))
+                emit('    if e < 0:')
+                emit('        return None')
+                if kind != 'any':
+                    emit('    while sp < e:')
+                    emit('        c = s[sp]')
+                    emit('        if not ({}):'.format(test))
+                    emit('            return None')
+                    emit('        sp += 1')
+                emit('    sp = e')
+            emit('    r = {}(sp)'.format(rest))
+            emit('    if r is not None:')
+            emit('        return r')
+            emit('    if sp >= n:')
+            emit('        return None')
+            if kind != 'any':
+                emit('    c = s[sp]')
+                emit('    if not ({}):'.format(test))
+                emit('        return None')
+            emit('    sp += 1')
+            return
+        if kind == 'any':
+            emit('e = n')
+        else:
+            emit('e = sp')
+            emit('while e < n:')
+            emit('    c = s[e]')
+            emit('    if not ({}):'.format(test))
+            emit('        break')
+            emit('    e += 1')
+        if quant == '+':
+            emit('if e == sp:')
+            emit('    return None')
+            emit('sp += 1')
+        if literal is not None:
+            emit('e += 1')
+            emit('while True:')
+            emit('    e = s.rfind({!r}, sp, e)'.format(literal))
+            emit('    if e < 0:')
+            emit('        return None')
+            emit('    r = {}(e)'.format(rest))
+            emit('    if r is not None:')
+            emit('        return r')
+        else:
+            emit('while e >= sp:')
+            emit('    r = {}(e)'.format(rest))
+            emit('    if r is not None:')
+            emit('        return r')
+            emit('    e -= 1')
+            emit('return None')
+
+
+class _CodeMatcher(_PatternMatcher):
+    '''Matcher that runs the code generated for a pattern.
+
+    Only match() differs from the interpreter, so searching, captures and
+    substitution behave exactly as they do in _PatternMatcher.
+    '''
+
+    def __init__(self, source, pattern, noanchor=False):
+        super().__init__(source, pattern, noanchor)
+        factory, self.capturecount = pattern._program(1 if self.anchor else 0)
+        self.cs = [PLACEHOLDER] * self.capturecount
+        self.ce = [PLACEHOLDER] * self.capturecount
+        self.entry = factory(source, self.srclen, self.cs, self.ce,
+                             self.balanceend)
+
+    def match(self, sp, pp):
+        end = self.entry(sp)
+        if end is not None:
+            state = self.state
+            state.capturenum = self.capturecount
+            for index in range(self.capturecount):
+                state.capturestarts[index] = self.cs[index]
+                state.captureends[index] = self.ce[index]
+        return end
+
+
+class _CancellableMatcher(_PatternMatcher):
+    '''Interpreter that checks a CancelToken at every backtracking step.'''
+
+    def __init__(self, source, pattern, noanchor=False, token=None):
+        super().__init__(source, pattern, noanchor)
+        self.token = token
+
+    def match(self, sp, pp):
+        self.token.check()
+        return super().match(sp, pp)
+
+
+def _codegen(items, escape, ignorecase=False, ascii=False):
+    '''Return (source, capture count) for the generated matcher, or None if
+    the pattern is too deeply nested to run without the recursion limit.'''
+    depth = sum(1 for kind, arg, quant in items
+                if quant is not None or kind in ('open', 'position', 'close'))
+    if depth >= MAXRECURSION:
+        return None
+    generator = _CodeGenerator(items, escape, ignorecase, ascii)
+    return generator.generate(), len(generator.captures)
+
+
+# Characters classified at a time when scanning a str for a leading %f
+_FRONTIERBLOCK = 1 << 12
+
+# Start positions tried one at a time near each literal found by an Index
+_INDEXMAXTRIES = 64
+
+# Below this length, setting up NumPy arrays costs more than it saves.
+_NUMPYMINLEN = 1 << 12
+
+_MAXDFASTATES = 10000
+
+
+def _dfaeligible(items):
+    '''Return whether items can be run by _DFA: single-char items only,
+    optionally followed by a final $, and not so many quantifiers that the
+    interpreter would hit its recursion limit.'''
+    depth = 0
+    for index, (kind, arg, quant) in enumerate(items):
+        if kind == 'end' and index == len(items) - 1:
+            continue
+        if kind not in ('any', 'char', 'class', 'set'):
+            return False
+        if quant is not None:
+            depth += 1
+    return depth < MAXRECURSION
+
+
+class _DFA:
+    '''Lazily built DFA for a pattern accepted by _dfaeligible().
+
+    A search makes two linear passes.  The forward pass follows every
+    candidate start at once, keeping threads in the order the backtracking
+    matcher would try them (earlier starts first, then quantifier
+    preferences), and finds where the interpreter's match ends.  The
+    reverse pass runs the reversed pattern backwards from that end to find
+    the leftmost start, which is where the interpreter's match begins.
+
+    Transitions are computed on first use and keyed by character class:
+    the tuple of results of every item predicate, so characters that no
+    item tells apart share their transitions.
+    '''
+
+    def __init__(self, items, escape, anchored, ignorecase=False,
+                 ascii=False):
+        self.endanchored = bool(items) and items[-1][0] == 'end'
+        if self.endanchored:
+            items = items[:-1]
+        self.anchored = anchored
+        expanded = []
+        for kind, arg, quant in items:
+            if quant == '+':  # x+ is tried exactly like x x*
+                expanded.append((kind, arg, None))
+                quant = '*'
+            expanded.append((kind, arg, quant))
+        keys = []
+        self.tests = []
+        for kind, arg, quant in expanded:
+            if (kind, arg) not in keys:
+                keys.append((kind, arg))
+                self.tests.append(_itempredicate(kind, arg, escape,
+                                                 ignorecase, ascii))
+        self.classids = {}
+        self.classes = []
+        self.forward = _DFATables(self, expanded, keys,
+                                  ordered=not self.endanchored)
+        self.reverse = _DFATables(self, expanded[::-1], keys, ordered=False)
+
+    def classid(self, c):
+        key = tuple(test(c) for test in self.tests)
+        try:
+            cid = self.classes.index(key)
+        except ValueError:
+            cid = len(self.classes)
+            self.classes.append(key)
+        self.classids[c] = cid
+        return cid
+
+    def search(self, source, init, laststart=None):
+        '''Return the span of the interpreter's match from init, or None.
+
+        With laststart, only matches starting at or before it are found.
+        '''
+        srclen = len(source)
+        if self.endanchored and laststart is not None:
+            return None  # the end of the buffer is not the end of input
+        classids = self.classids
+        tables = self.forward
+        sid = tables.start(self.anchored)
+        end = init if tables.accept[sid] else None
+        pos = init
+        while pos < srclen:
+            if laststart is not None and pos >= laststart:
+                sid = tables.noinject(sid)
+            c = source[pos]
+            try:
+                cid = classids[c]
+            except KeyError:
+                cid = self.classid(c)
+            sid = tables.step(sid, cid)
+            pos += 1
+            if tables.accept[sid]:
+                end = pos
+            elif tables.dead[sid]:
+                break
+        if self.endanchored:
+            end = srclen if pos == srclen and tables.final[sid] else None
+        if end is None:
+            return None
+        tables = self.reverse
+        sid = tables.start(True)
+        start = end if tables.final[sid] else None
+        pos = end
+        while pos > init:
+            pos -= 1
+            c = source[pos]
+            try:
+                cid = classids[c]
+            except KeyError:
+                cid = self.classid(c)
+            sid = tables.step(sid, cid)
+            if tables.final[sid]:
+                start = pos
+            elif tables.dead[sid]:
+                break
+        return start, end
+
+
+class _DFATables:
+    '''States and transitions for one direction of a _DFA.
+
+    A state is a tuple of item positions plus a flag telling whether a new
+    thread is started at every character.  Position len(items) means the
+    whole pattern has been consumed.  In ordered mode positions are kept in
+    the order the interpreter tries them, and everything after a complete
+    match is dropped because the interpreter would never get to it.
+    '''
+
+    def __init__(self, dfa, items, keys, ordered):
+        self.dfa = dfa
+        self.items = items
+        self.testindex = [keys.index((kind, arg))
+                          for kind, arg, quant in items]
+        self.ordered = ordered
+        self.size = len(items)
+        self.closures = {}
+        self.reset()
+
+    def reset(self):
+        self.keys = []
+        self.ids = {}
+        self.transitions = []
+        self.final = []  # the whole pattern has been consumed
+        self.accept = []  # ... and that ends a match (ordered mode only)
+        self.dead = []  # no thread is left and none will be started
+
+    def closure(self, index):
+        # Positions reachable from index without consuming anything, in
+        # the order the interpreter tries them.
+        try:
+            return self.closures[index]
+        except KeyError:
+            pass
+        if index == self.size:
+            result = (index,)
+        else:
+            quant = self.items[index][2]
+            if quant is None:
+                result = (index,)
+            elif quant == '-':
+                result = self.closure(index + 1) + (index,)
+            else:  # '?' and '*' prefer to consume
+                result = (index,) + self.closure(index + 1)
+        self.closures[index] = result
+        return result
+
+    def intern(self, positions, inject):
+        seen = set()
+        kept = []
+        for position in positions:
+            if position not in seen:
+                seen.add(position)
+                kept.append(position)
+                if position == self.size and self.ordered:
+                    inject = False  # later starts lose to this match
+                    break
+        if not self.ordered:
+            kept.sort()
+        key = (tuple(kept), inject)
+        try:
+            return self.ids[key]
+        except KeyError:
+            pass
+        if len(self.keys) >= _MAXDFASTATES:
+            self.reset()  # bound memory on pathological inputs
+        sid = len(self.keys)
+        self.keys.append(key)
+        self.ids[key] = sid
+        self.transitions.append({})
+        final = self.size in seen
+        self.final.append(final)
+        self.accept.append(final and self.ordered)
+        self.dead.append(not kept and not inject)
+        return sid
+
+    def start(self, anchored):
+        return self.intern(self.closure(0), not anchored)
+
+    def noinject(self, sid):
+        positions, inject = self.keys[sid]
+        return self.intern(positions, False) if inject else sid
+
+    def step(self, sid, cid):
+        try:
+            return self.transitions[sid][cid]
+        except KeyError:
+            pass
+        key = self.keys[sid]
+        positions, inject = key
+        matches = self.dfa.classes[cid]
+        following = []
+        for position in positions:
+            if position == self.size:
+                continue
+            if matches[self.testindex[position]]:
+                if self.items[position][2] in (None, '?'):
+                    following.extend(self.closure(position + 1))
+                else:
+                    following.extend(self.closure(position))
+        if inject:
+            following.extend(self.closure(0))
+        result = self.intern(following, inject)
+        # cache the transition unless intern() just reset the tables
+        if sid < len(self.keys) and self.keys[sid] is key:
+            self.transitions[sid][cid] = result
+        return result
+
+
+class _DFAMatcher(_PatternMatcher):
+    '''Matcher that answers searches with a _DFA instead of backtracking.
+
+    Only capture-free patterns use it, so every search result is built
+    from the match span alone.
+    '''
+
+    def __init__(self, source, pattern, noanchor=False):
+        super().__init__(source, pattern, noanchor)
+        self.pp = 1 if self.anchor else 0
+        self.dfa = pattern._dfa(self.pp)
+
+    def find_aux(self, type, init=0, plain=False, laststart=None,
+                 anchored=False):
+        if type == 'find' and (plain or self.nospecials):
+            return super().find_aux(type, init, plain, laststart, anchored)
+        if init < 0:
+            init = 0
+        if init > self.srclen:  # start after source's end?
+            return None  # no chance of finding anything
+        if laststart is not None and init > laststart:
+            return None
+        dfa = self.compiled._dfa(self.pp, True) if anchored else self.dfa
+        span = dfa.search(self.source, init, laststart)
+        if span is None:
+            return None
+        start, end = span
+        if self.state is None:
+            self.state = _MatchState(self.source, self.pattern)
+        self.state.reset(start)
+        if type in ('span', 'find'):
+            return span
+        whole = self.source[start:end]
+        if type == 'match':
+            return whole
+        elif type == 'gmatch':
+            return span, whole
+        else:  # gsub
+            return span, (whole,)
+
+
+class _CancellableDFAMatcher(_DFAMatcher):
+    '''DFA matcher that checks a CancelToken before every search.
+
+    A single search is linear in the length of the source, so there is
+    no backtracking to check inside it.
+    '''
+
+    def __init__(self, source, pattern, noanchor=False, token=None):
+        super().__init__(source, pattern, noanchor)
+        self.token = token
+
+    def find_aux(self, type, init=0, plain=False, laststart=None,
+                 anchored=False):
+        self.token.check()
+        return super().find_aux(type, init, plain, laststart, anchored)
+
+
+class Pattern:
+    '''A compiled Lua pattern.
+
+    The escape character in effect when the pattern is compiled is stored
+    with it, so later calls to set_escape_char() do not affect it.  Pass
+    codegen=True to compile() to run the pattern through generated Python
+    code instead of the interpreter.  Pass ignorecase=True to match
+    literal characters and sets regardless of case, and ascii=True to
+    classify characters with the ASCII tables of stock Lua's C locale
+    instead of Unicode.  Patterns can be pickled; the parsed form and any
+    generated code travel with them.
+    '''
+
+    def __init__(self, pattern, codegen=False, ignorecase=False, ascii=False):
+        self.pattern = pattern
+        self.escape = ESCAPE
+        self.codegen = codegen
+        self.ignorecase = ignorecase
+        self.ascii = ascii
+        self._reset()
+
+    def _reset(self):
+        self.nospecials = not self.ignorecase and not any(
+            c in self.pattern for c in SPECIALS + self.escape
+        )
+        self._items = {}
+        self._bounds = {}
+        self._sources = {}
+        self._predicates = {}
+        self._programs = {}
+        self._dfas = {}
+        self._runtable = None
+        self._runs = {}
+        self._optimized = None
+        self._frontiertests = {}
+
+    def __repr__(self):
+        args = [repr(self.pattern)]
+        for flag in ('ignorecase', 'ascii'):
+            if getattr(self, flag):
+                args.append(flag + '=True')
+        return 'luapatt.compile({})'.format(', '.join(args))
+
+    def __getstate__(self):
+        return {
+            'pattern': self.pattern,
+            'escape': self.escape,
+            'codegen': self.codegen,
+            'ignorecase': self.ignorecase,
+            'ascii': self.ascii,
+            'program': self._optimized,
+            'items': self._items,
+            'bounds': self._bounds,
+            'sources': self._sources,
+        }
+
+    def __setstate__(self, state):
+        self.pattern = state['pattern']
+        self.escape = state['escape']
+        self.codegen = state['codegen']
+        self.ignorecase = state['ignorecase']
+        self.ascii = state['ascii']
+        self._reset()
+        self._optimized = state['program']
+        self._items.update(state['items'])
+        self._bounds.update(state['bounds'])
+        self._sources.update(state['sources'])
+
+    @property
+    def program(self):
+        '''The optimized pattern text that is actually run; see explain().'''
+        if self._optimized is None:
+            pattern = self.pattern
+            pp = 1 if pattern[:1] == '^' else 0
+            self._optimized = pattern
+            if not (pp and pattern[1:2] in ('*', '+', '-', '?')):
+                # (otherwise '^' is a quantified literal in gmatch())
+                items = _parse(pattern, self.escape, pp)
+                optimized = _optimize(items, self.escape)
+                if optimized != items:
+                    self._optimized = (pattern[:pp] +
+                                       _unparse(optimized, self.escape))
+        return self._optimized
+
+    def explain(self):
+        '''Return a listing of the optimized program, one item per line,
+        with runs of literal characters shown as a single comparison.'''
+        pp = 1 if self.pattern[:1] == '^' else 0
+        lines = [
+            'pattern {!r}'.format(self.pattern),
+            'program {!r}'.format(self.program),
+            'engine  {}'.format(self.engine),
+        ]
+        if pp:
+            lines.append('  anchor')
+        escape = self.escape
+        for kind, arg, quant in _literalruns(self._parse(pp)):
+            if kind in ('literal', 'char'):
+                text = repr(arg)
+            elif kind == 'class':
+                text = escape + arg
+            elif kind in ('set', 'frontier'):
+                text = '[{}]'.format(arg)
+            elif kind == 'balance':
+                text = escape + 'b' + arg
+            elif kind == 'backref':
+                text = escape + str(arg)
+            elif kind == 'error':
+                text = str(arg)
+            else:
+                text = ''
+            parts = [text, quant] if quant else [text]
+            lines.append('  {:<9}{}'.format(kind, ' '.join(parts)).rstrip())
+        return '\n'.join(lines)
+
+    def _parse(self, pp):
+        try:
+            return self._items[pp]
+        except KeyError:
+            items = self._items[pp] = _parse(self.program, self.escape, pp)
+            return items
+
+    def _getbounds(self, pp):
+        # (minimum, maximum, endanchored) for the pattern from pp; see
+        # _lengths() for the meaning of the values
+        try:
+            return self._bounds[pp]
+        except KeyError:
+            bounds = self._bounds[pp] = _lengths(self._parse(pp))
+            return bounds
+
+    def _program(self, pp):
+        try:
+            return self._programs[pp]
+        except KeyError:
+            pass
+        try:
+            generated = self._sources[pp]
+        except KeyError:
+            generated = _codegen(self._parse(pp), self.escape,
+                                 self.ignorecase, self.ascii)
+            self._sources[pp] = generated
+        if generated is not None:
+            code, capturecount = generated
+            namespace = {
+                '_category': unicodedata.category,
+                'PatternSyntaxError': PatternSyntaxError,
+                'PatternTooManyCaptures': PatternTooManyCaptures,
+                '_casevariants': _casevariants,
+            }
+            for letter, table in _ASCIICLASSES.items():
+                namespace['_ascii' + letter] = table
+            exec(code, namespace)
+            generated = namespace['_factory'], capturecount
+        self._programs[pp] = generated
+        return generated
+
+    def _dfa(self, pp, anchored=None):
+        # anchored defaults to whether the pattern starts with '^'
+        if anchored is None:
+            anchored = pp == 1
+        try:
+            return self._dfas[pp, anchored]
+        except KeyError:
+            pass
+        items = self._parse(pp)
+        if _dfaeligible(items):
+            dfa = _DFA(items, self.escape, anchored, self.ignorecase,
+                       self.ascii)
+        else:
+            dfa = None
+        self._dfas[pp, anchored] = dfa
+        return dfa
+
+    def _prefix(self, pp):
+        # The literal text every match from pp starts with, ending at the
+        # first item that is not a plain character or a capture boundary,
+        # so no item that may raise is skipped over.
+        prefix = []
+        for kind, arg, quant in self._parse(pp):
+            if kind in ('open', 'position'):
+                continue
+            if kind != 'char' or quant not in (None, '+'):
+                break
+            prefix.append(arg)
+            if quant == '+':
+                break
+        return ''.join(prefix)
+
+    def _startitem(self, pp):
+        # The first item from pp that consumes text or tests a position,
+        # past any capture boundaries, or None.
+        for item in self._parse(pp):
+            if item[0] not in ('open', 'position'):
+                return item
+        return None
+
+    def _frontiertest(self, pp):
+        # The set predicate of a %f that every match from pp starts with
+        try:
+            return self._frontiertests[pp]
+        except KeyError:
+            pass
+        item = self._startitem(pp)
+        test = None
+        if item is not None and item[0] == 'frontier':
+            test = _itempredicate('set', item[1], self.escape,
+                                  self.ignorecase, self.ascii)
+        self._frontiertests[pp] = test
+        return test
+
+    def _engine(self, pp):
+        if self.codegen and self._program(pp) is not None:
+            return 'codegen'
+        elif self._dfa(pp) is not None:
+            return 'dfa'
+        else:
+            return 'backtrack'
+
+    @property
+    def engine(self):
+        '''The engine used to search with this pattern: 'dfa' for patterns
+        without captures, back-references, %b or %f, 'codegen' if requested
+        with compile(), otherwise 'backtrack'.'''
+        return self._engine(1 if self.pattern[:1] == '^' else 0)
+
+    def _matcher(self, source, noanchor=False, end=None):
+        '''Return a matcher for source.  With end, the matcher treats
+        source as if it were source[:end], without copying it; only
+        rfind_aux() supports that.'''
+        anchor = not noanchor and self.pattern[:1] == '^'
+        engine = self._engine(1 if anchor else 0)
+        if end is not None and engine == 'codegen':
+            engine = 'backtrack'  # generated code reads up to len(source)
+        token = getattr(_cancellation, 'token', None)
+        if token is not None:
+            if engine == 'dfa':
+                matcher = _CancellableDFAMatcher(source, self, noanchor, token)
+            else:
+                matcher = _CancellableMatcher(source, self, noanchor, token)
+        elif engine == 'codegen':
+            matcher = _CodeMatcher(source, self, noanchor)
+        elif engine == 'dfa':
+            matcher = _DFAMatcher(source, self, noanchor)
+        else:
+            matcher = _PatternMatcher(source, self, noanchor)
+        if end is not None:
+            matcher.srclen = end
+        return matcher
+
+    def find(self, source, init=0, plain=False):
+        if plain and self.ignorecase:
+            # str.find() is case-sensitive; search for the escaped text
+            specials = SPECIALS + ')' + ESCAPE
+            literal = ''.join(ESCAPE + c if c in specials else c
+                              for c in self.pattern)
+            return _compile(literal, ignorecase=True).find(source, init)
+        matcher = self._matcher(source)
+        return matcher.find_aux(type='find', init=init, plain=plain)
+
+    def rfind(self, source, end=None):
+        '''Return the rightmost match in source[:end] like find() would,
+        trying start positions from right to left.'''
+        if end is not None:
+            # Bound the search instead of slicing, which would copy the
+            # source and turn a Source back into a plain str
+            end = slice(end).indices(len(source))[1]
+            if end == len(source):
+                end = None
+        if self.nospecials:
+            start = source.rfind(self.pattern, 0, end)
+            if start < 0:
+                return None
+            return start, start + len(self.pattern)
+        matcher = self._matcher(source, end=end)
+        return matcher.rfind_aux()
+
+    def match(self, source, init=0):
+        matcher = self._matcher(source)
+        return matcher.find_aux(type='match', init=init, plain=False)
+
+    def _runspans(self, source):
+        '''Return NumPy arrays of the starts and ends of all matches, for a
+        pattern that is one single-char item repeated with '+'.
+
+        Such a pattern matches exactly the maximal runs of characters the
+        item accepts, which are found in bulk from a mask over the whole
+        source.  Returns None if the pattern is not of that form, the
+        source is too short to be worth it or NumPy is not installed.
+        '''
+        if len(source) < _NUMPYMINLEN or self.pattern[:1] == '^':
+            return None
+        items = self._parse(0)
+        if (len(items) != 1 or items[0][2] != '+' or
+                items[0][0] not in ('any', 'char', 'class', 'set')):
+            return None
+        numpy = _importnumpy(False)
+        if numpy is None:
+            return None
+        kind, arg, quant = items[0]
+        test = _itempredicate(kind, arg, self.escape, self.ignorecase,
+                              self.ascii)
+        if self._runtable is None:  # Latin-1 lookup table
+            self._runtable = numpy.array([bool(test(chr(code)))
+                                          for code in range(256)])
+        codes = numpy.frombuffer(source.encode('utf-32-le', 'surrogatepass'),
+                                 dtype=numpy.uint32)
+        small = codes < 256
+        if small.all():
+            mask = self._runtable[codes]
+        else:
+            mask = numpy.zeros(len(codes), dtype=bool)
+            mask[small] = self._runtable[codes[small]]
+            large = ~small
+            values, inverse = numpy.unique(codes[large], return_inverse=True)
+            results = numpy.array([bool(test(chr(code)))
+                                   for code in values.tolist()])
+            mask[large] = results[inverse]
+        edges = numpy.diff(mask.view(numpy.int8), prepend=0, append=0)
+        return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)
+
+    def gmatch(self, source):
+        spans = self._runspans(source)
+        if spans is not None:
+            for start, end in zip(spans[0].tolist(), spans[1].tolist()):
+                yield source[start:end]
+            return
+        matcher = self._matcher(source, noanchor=True)
+        init = 0
+        result = True
+        while result:
+            result = matcher.find_aux(type='gmatch', init=init, plain=False)
+            if result:
+                newstart = result[0][1]
+                if newstart == result[0][0]:  # empty match at starting pos?
+                    newstart += 1  # go forward at least one character
+                init = newstart
+                yield result[1]
+
+    def contains(self, source, init=0):
+        '''Return whether the pattern matches anywhere in source.'''
+        if self.nospecials:
+            if init > len(source):  # as in find_aux()
+                return False
+            return source.find(self.pattern, max(init, 0)) >= 0
+        matcher = self._matcher(source)
+        return matcher.find_aux(type='span', init=init) is not None
+
+    def count(self, source):
+        '''Return the number of matches gmatch() would produce.'''
+        if self.nospecials and ')' not in self.pattern:
+            # (gmatch() reports a stray ')' that find() takes literally)
+            return source.count(self.pattern)
+        spans = self._runspans(source)
+        if spans is not None:
+            return len(spans[0])
+        matcher = self._matcher(source, noanchor=True)
+        find_aux = matcher.find_aux
+        init = 0
+        total = 0
+        while True:
+            result = find_aux(type='span', init=init)
+            if result is None:
+                return total
+            total += 1
+            start, init = result
+            if start == init:  # empty match at starting position?
+                init += 1  # go forward at least one character
+
+    def extract_columns(self, source, spans=False, numpy=None):
+        '''Collect the captures of every match into one column per capture.
+
+        If source is a string, columns are filled from every match, as with
+        gmatch().  Otherwise source is taken to be an iterable of lines,
+        and each line contributes its first match, as with find(); lines
+        without a match are skipped.  A pattern without captures yields a
+        single column of whole matches.
+
+        String captures are collected in lists.  Position captures are
+        collected in compact integer arrays, as are the match spans if
+        spans is true: start and end columns are appended, preceded in
+        line mode by a column of line numbers, and positions are relative
+        to each line.  With numpy=True the integer columns are returned as
+        NumPy arrays; with the default of None, this is done whenever NumPy
+        is installed.
+        '''
+        lines = not isinstance(source, str)
+        pp = 1 if lines and self.pattern[:1] == '^' else 0
+        kinds = [kind == 'position' for kind, arg, quant in self._parse(pp)
+                 if kind in ('open', 'position')][:MAXCAPTURES]
+        columns = [array(_INDEXTYPECODE) if isposition else []
+                   for isposition in kinds or [False]]
+        spancolumns = [array(_INDEXTYPECODE)
+                       for _ in range(3 if lines else 2)] if spans else []
+
+        def collect(text, state, start, end):
+            if not kinds:
+                columns[0].append(text[start:end])
+            else:
+                starts = state.capturestarts
+                ends = state.captureends
+                for index, isposition in enumerate(kinds):
+                    if isposition:
+                        columns[index].append(starts[index])
+                    else:
+                        columns[index].append(
+                            text[starts[index]:ends[index]]
+                        )
+            if spans:
+                spancolumns[-2].append(start)
+                spancolumns[-1].append(end)
+
+        if lines:
+            for row, line in enumerate(source):
+                matcher = self._matcher(line)
+                result = matcher.find_aux(type='span')
+                if result is not None:
+                    collect(line, matcher.state, *result)
+                    if spans:
+                        spancolumns[0].append(row)
+        else:
+            matcher = self._matcher(source, noanchor=True)
+            init = 0
+            while True:
+                result = matcher.find_aux(type='span', init=init)
+                if result is None:
+                    break
+                collect(source, matcher.state, *result)
+                start, init = result
+                if start == init:  # empty match at starting position?
+                    init += 1  # go forward at least one character
+        columns.extend(spancolumns)
+        np = _importnumpy(numpy) if numpy is not False else None
+        if np is not None:
+            columns = [np.frombuffer(column, 'i{}'.format(column.itemsize))
+                       if isinstance(column, array) else column
+                       for column in columns]
+        return columns
+
+    def split(self, source, maxsplit=None, captures=False):
+        '''Yield the pieces of source between matches of the pattern.
+
+        Empty matches split the source exactly where gsub() would insert a
+        replacement.  At most maxsplit splits are made, if given.  With
+        captures=True, the captures of each match are yielded between the
+        pieces it separates, as re.split() does with groups.
+        '''
+        matcher = self._matcher(source)
+        init = 0
+        piecestart = 0
+        splits = 0
+        if matcher.anchor and (maxsplit is None or maxsplit > 1):
+            maxsplit = 1  # not possible to match more than one if anchored
+        while maxsplit is None or splits < maxsplit:
+            result = matcher.find_aux(type='gsub', init=init, plain=False)
+            if not result:
+                break
+            splits += 1
+            matchstart, matchend = result[0]
+            yield source[piecestart:matchstart]
+            if captures and matcher.state.capturenum:
+                for capture in result[1]:
+                    yield capture
+            piecestart = init = matchend
+            if matchstart == matchend:  # empty match?
+                init += 1  # the skipped character stays in the next piece
+        yield source[piecestart:]
+
+    def gsub(self, source, repl, limit=None, count=False):
+        replcount = [0]
+        finalstring = ''.join(self._subpieces(source, repl, limit, replcount))
+        if count:
+            return finalstring, replcount[0]
+        else:
+            return finalstring
+
+    def gsub_iter(self, source, repl, limit=None):
+        '''Like gsub(), but yield the pieces of the result instead of
+        joining them.
+
+        source may also be an iterable of strings (such as a text file),
+        which are treated as consecutive chunks of one source string and
+        read only as far as needed.  This requires a pattern whose matches
+        have a bounded length, so that only a bounded window of the input
+        needs to be held in memory; ValueError is raised otherwise.
+        '''
+        if isinstance(source, str):
+            return self._subpieces(source, repl, limit, [0])
+        return self._subchunks(iter(source), repl, limit, [0])
+
+    def gsub_to(self, writer, source, repl, limit=None, encoding='utf-8'):
+        '''Write the result of gsub_iter() to writer and return the number
+        of substitutions made.
+
+        writer may be a text stream or a binary one, in which case the
+        output is encoded with encoding.
+        '''
+        binary = (isinstance(writer, (io.RawIOBase, io.BufferedIOBase)) or
+                  'b' in getattr(writer, 'mode', ''))
+        replcount = [0]
+        if isinstance(source, str):
+            pieces = self._subpieces(source, repl, limit, replcount)
+        else:
+            pieces = self._subchunks(iter(source), repl, limit, replcount)
+        write = writer.write
+        for piece in pieces:
+            write(piece.encode(encoding) if binary else piece)
+        return replcount[0]
+
+    def _subpieces(self, source, repl, limit, replcount):
+        matcher = self._matcher(source)
+        spans = self._runspans(source)
+        if spans is not None:
+            init = 0
+            for start, end in zip(spans[0].tolist(), spans[1].tolist()):
+                if limit is not None and replcount[0] >= limit:
+                    break
+                replcount[0] += 1
+                if init < start:
+                    yield source[init:start]
+                yield matcher.subst((source[start:end],), repl, start, end)
+                init = end
+            if init < len(source):
+                yield source[init:]
+            return
+        init = 0
+        if matcher.anchor:
+            limit = 1  # not possible to match more than one if anchored
+        elif limit is None:
+            # Maximum possible substitutions is one more than len(source)
+            # e.g. luapatt.gsub('test', '.-', '=') returns '=t=e=s=t='
+            limit = len(source) + 1
+        while replcount[0] < limit:
+            result = matcher.find_aux(type='gsub', init=init, plain=False)
+            if not result:
+                break
+            replcount[0] += 1
+            matchstart, matchend = result[0]
+            if init < matchstart:
+                yield source[init:matchstart]
+            yield matcher.subst(result[1], repl, matchstart, matchend)
+            init = matchend
+            if matchstart == matchend:  # empty match?
+                if matchend < matcher.srclen:
+                    yield source[matchend]  # skip a character
+                init += 1
+        if init < len(source):
+            yield source[init:]  # collect the rest of the source string
+
+    def _subchunks(self, chunks, repl, limit, replcount):
+        anchor = self.pattern[:1] == '^'
+        maximum = self._getbounds(1 if anchor else 0)[1]
+        if maximum is None:
+            raise ValueError('chunked input requires a pattern with a '
+                             'bounded match length')
+        if anchor:
+            limit = 1
+        # buffer holds the unwritten input plus, once past the first window,
+        # one character of lookbehind for frontier patterns; init is where
+        # the next match attempt starts.
+        buffer = ''
+        init = 0
+        eof = False
+        while True:
+            # A match attempt starting at init never looks further ahead
+            # than init + maximum, so fill the buffer at least that far.
+            while not eof and len(buffer) <= init + maximum:
+                try:
+                    buffer += next(chunks)
+                except StopIteration:
+                    eof = True
+            if limit is not None and replcount[0] >= limit:
+                break
+            laststart = None if eof else len(buffer) - maximum - 1
+            matcher = self._matcher(buffer)
+            while limit is None or replcount[0] < limit:
+                result = matcher.find_aux(type='gsub', init=init,
+                                          laststart=laststart)
+                if not result:
+                    break
+                replcount[0] += 1
+                matchstart, matchend = result[0]
+                if init < matchstart:
+                    yield buffer[init:matchstart]
+                yield matcher.subst(result[1], repl, matchstart, matchend)
+                init = matchend
+                if matchstart == matchend:  # empty match?
+                    if matchend < matcher.srclen:
+                        yield buffer[matchend]  # skip a character
+                    init += 1
+            if eof or anchor:
+                break
+            if limit is not None and replcount[0] >= limit:
+                break
+            # Nothing else can start before laststart + 1: write it out and
+            # keep one character of lookbehind.
+            if init <= laststart:
+                yield buffer[init:laststart + 1]
+                init = laststart + 1
+            buffer = buffer[init - 1:]
+            init = 1
+        if init < len(buffer):
+            yield buffer[init:]
+        for chunk in chunks:
+            yield chunk
+
+
+_UNBOUNDED = ('*', '+', '-')
+_SAMPLECHARS = ''.join(map(chr, range(128))) + '\xa0\xe9\xc9٣中'
+
+
+def _overlap(first, second, escape, ignorecase, ascii):
+    '''Return whether some character is matched by both single-char items.
+
+    Checked over the ASCII range, a few non-ASCII samples and every
+    character written in either item, which is enough to tell the common
+    cases apart without being exhaustive.
+    '''
+    tests = [_itempredicate(kind, arg, escape, ignorecase, ascii)
+             for kind, arg in (first, second)]
+    chars = set(_SAMPLECHARS)
+    for kind, arg in (first, second):
+        if kind in ('char', 'set'):
+            chars.update(arg)
+    return any(all(test(c) for test in tests) for c in chars)
+
+
+class Analysis:
+    '''The result of analyze().
+
+    Attributes: pattern, captures (the number of captures), minlength and
+    maxlength (bounds on the length of a match; maxlength is None when
+    unbounded), engine (as Pattern.engine), literals (runs of literal text
+    every match contains, in order), risk ('low', 'medium' or 'high') and
+    warnings (one description per finding behind the risk rating).
+    '''
+
+    def __init__(self, compiled):
+        self.pattern = compiled.pattern
+        pp = 1 if compiled.pattern[:1] == '^' else 0
+        # The pattern as written, not the optimized program, so that the
+        # warnings point at what the caller can change.
+        items = _parse(compiled.pattern, compiled.escape, pp)
+        self.captures = self._checkcaptures(items, compiled.escape)
+        self.minlength, self.maxlength, _ = compiled._getbounds(pp)
+        self.engine = compiled._engine(pp)
+        self.literals = self._literals(items)
+        self.warnings = []
+        score = self._scan(items, compiled, anchored=pp == 1)
+        if self.engine == 'dfa':
+            score = 0  # the DFA never backtracks, whatever the pattern
+        self.risk = 'low' if score == 0 else 'medium' if score == 1 else 'high'
+
+    def __repr__(self):
+        return ('<luapatt.Analysis {!r}: captures={} length={}..{} '
+                'engine={!r} risk={!r}>'.format(
+                    self.pattern, self.captures, self.minlength,
+                    self.maxlength, self.engine, self.risk))
+
+    @staticmethod
+    def _checkcaptures(items, escape):
+        # Raise the first error any match could run into, and count the
+        # captures otherwise.
+        count = 0
+        stack = []
+        for kind, arg, quant in items:
+            if kind == 'error':
+                raise arg
+            elif kind in ('open', 'position'):
+                if count >= MAXCAPTURES:
+                    raise PatternTooManyCaptures
+                if kind == 'open':
+                    stack.append(count)
+                count += 1
+            elif kind == 'close':
+                if not stack:
+                    raise PatternSyntaxError("unmatched ')'")
+                stack.pop()
+            elif kind == 'backref' and (arg - 1 >= count or arg - 1 in stack
+                                        or arg < 1):
+                raise PatternSyntaxError(
+                    'invalid capture index {}{}'.format(escape, arg)
+                )
+        if stack:
+            raise PatternSyntaxError('unfinished capture')
+        return count
+
+    @staticmethod
+    def _literals(items):
+        literals = []
+        run = ''
+        carried = 0  # length of the run already reported with x+
+        for kind, arg, quant in items:
+            if kind in ('open', 'close', 'position'):
+                continue  # zero-width; the text around it is contiguous
+            if kind == 'char' and quant is None:
+                run += arg
+                continue
+            if kind == 'char' and quant == '+':
+                # The last repetition also starts the next run.
+                literals.append(run + arg)
+                run, carried = arg, 1
+                continue
+            if len(run) > carried:
+                literals.append(run)
+            run, carried = '', 0
+        if len(run) > carried:
+            literals.append(run)
+        return tuple(literals)
+
+    def _scan(self, items, compiled, anchored):
+        # Add a warning for each backtracking hazard and return how many
+        # were found.
+        escape = compiled.escape
+        flags = compiled.ignorecase, compiled.ascii
+        depth = 0
+        previous = None  # the last quantified single-char item, if adjacent
+        lazy = False  # has a lazy quantifier been seen?
+        stack = []
+        quantified = []  # capture index -> contains a quantifier?
+        for kind, arg, quant in items:
+            if quant is not None or kind in ('open', 'position', 'close'):
+                depth += 1
+            if kind in ('open', 'position'):
+                if kind == 'open':
+                    stack.append(len(quantified))
+                quantified.append(False)
+                continue
+            elif kind == 'close':
+                stack.pop()
+                continue
+            if quant in _UNBOUNDED:
+                for index in stack:
+                    quantified[index] = True
+                if (previous is not None and
+                        _overlap(previous, (kind, arg), escape, *flags)):
+                    self.warnings.append(
+                        'adjacent quantifiers over overlapping characters '
+                        'can split a run in many ways'
+                    )
+                previous = (kind, arg)
+                lazy = lazy or quant == '-'
+            else:
+                previous = None
+            if kind == 'backref' and quantified[arg - 1]:
+                self.warnings.append(
+                    'back-reference to capture {} whose length depends '
+                    'on a quantifier'.format(arg)
+                )
+            elif kind == 'end' and lazy and not anchored:
+                self.warnings.append(
+                    "lazy expansion before '$' is retried to the end of "
+                    'the source from every start position'
+                )
+        if depth >= MAXRECURSION:
+            self.warnings.append('pattern may exceed the recursion limit')
+        return len(self.warnings)
+
+
+def _firstpredicate(compiled, pp):
+    '''Return a predicate every first character of a match from pp passes,
+    or None if the pattern gives no such guarantee.'''
+    for kind, arg, quant in compiled._parse(pp):
+        if kind in ('open', 'position'):
+            continue  # zero-width; look at what follows
+        if kind in ('any', 'char', 'class', 'set') and quant in (None, '+'):
+            return _itempredicate(kind, arg, compiled.escape,
+                                  compiled.ignorecase, compiled.ascii)
+        if kind == 'balance':
+            return arg[0].__eq__
+        return None
+    return None
+
+
+class _FirstCharIndex:
+    '''Map a character to the compiled patterns whose match can start
+    with it, in their original order.  Built lazily, one character at a
+    time; candidates(None) gives the patterns that can match at the end
+    of the source.'''
+
+    def __init__(self, patterns):
+        self.firsts = []
+        for compiled in patterns:
+            pp = 1 if compiled.pattern[:1] == '^' else 0
+            self.firsts.append(_firstpredicate(compiled, pp))
+        self.dispatch = {None: tuple(index for index, test
+                                     in enumerate(self.firsts)
+                                     if test is None)}
+
+    def candidates(self, c):
+        try:
+            return self.dispatch[c]
+        except KeyError:
+            pass
+        result = self.dispatch[c] = tuple(
+            index for index, test in enumerate(self.firsts)
+            if test is None or test(c)
+        )
+        return result
+
+
+class Scanner:
+    '''Tokenize a source with an ordered list of (pattern, action) pairs.
+
+    At each position, the first pattern that matches there with a
+    non-empty match wins; a leading '^' in a pattern is allowed but not
+    needed.  The value of a match is what match() would return for it.  If
+    the action is None, the match is skipped; if it is callable, it is
+    called with the scanner and the value, and its result is yielded
+    unless it is None; otherwise (action, value) is yielded, so the action
+    serves as the token type.
+
+    All patterns are compiled once.  Candidates at each position are
+    narrowed down by the character found there, and each is matched in
+    place, without slicing the source.
+    '''
+
+    def __init__(self, lexicon, ignorecase=False, ascii=False):
+        self.lexicon = [(_compile(pattern, ignorecase=ignorecase, ascii=ascii),
+                         action) for pattern, action in lexicon]
+        self.index = _FirstCharIndex(compiled
+                                     for compiled, action in self.lexicon)
+
+    def scan(self, source, pos=0):
+        '''Yield the tokens of source from pos on.
+
+        Raises ScanError at the first position where no pattern matches.
+        '''
+        matchers = [compiled._matcher(source)
+                    for compiled, action in self.lexicon]
+        srclen = len(source)
+        while pos < srclen:
+            for index in self.index.candidates(source[pos]):
+                result = matchers[index].find_aux(type='gmatch', init=pos,
+                                                  anchored=True)
+                if result is not None and result[0][1] > pos:
+                    break
+            else:
+                raise ScanError(pos)
+            (start, pos), value = result
+            action = self.lexicon[index][1]
+            if action is None:
+                continue
+            elif callable(action):
+                token = action(self, value)
+                if token is not None:
+                    yield token
+            else:
+                yield action, value
+
+
+class NeedleSet:
+    '''An Aho-Corasick automaton over literal needles, built once and
+    reusable for any number of searches with find_any() and gmatch_any().
+
+    A search reports the leftmost match; of the needles matching there,
+    the longest wins, and of equal needles, the first given.  With
+    ignorecase, needles and source are compared after lowercasing each
+    character on its own, so reported positions always refer to the
+    unmodified source.
+    '''
+
+    def __init__(self, needles, ignorecase=False):
+        self.needles = tuple(needles)
+        self.ignorecase = ignorecase
+        self.folds = {}
+        goto = [{}]
+        output = [None]  # state -> (length, index) of its longest needle
+        depth = [0]
+        for index, needle in enumerate(self.needles):
+            if not needle:
+                raise ValueError('needles cannot be empty')
+            state = 0
+            for c in needle:
+                c = self.fold(c)
+                following = goto[state].get(c)
+                if following is None:
+                    following = goto[state][c] = len(goto)
+                    goto.append({})
+                    output.append(None)
+                    depth.append(depth[state] + 1)
+                state = following
+            if output[state] is None:
+                output[state] = (len(needle), index)
+        fail = [0] * len(goto)
+        order = list(goto[0].values())
+        for state in order:  # breadth-first, so fail links come first
+            for c, following in goto[state].items():
+                order.append(following)
+                link = fail[state]
+                while link and c not in goto[link]:
+                    link = fail[link]
+                fail[following] = goto[link].get(c, 0)
+                if output[following] is None:
+                    output[following] = output[fail[following]]
+        self.goto = goto
+        self.fail = fail
+        self.output = output
+        self.depth = depth
+
+    def __repr__(self):
+        return '<luapatt.NeedleSet of {} needles>'.format(len(self.needles))
+
+    def fold(self, c):
+        if not self.ignorecase:
+            return c
+        try:
+            return self.folds[c]
+        except KeyError:
+            pass
+        lower = c.lower()
+        result = self.folds[c] = lower if len(lower) == 1 else c
+        return result
+
+    def find(self, source, init=0):
+        '''Return (start, end, needle) for the leftmost match in source at
+        or after init, or None.'''
+        goto, fail, output, depth = self.goto, self.fail, self.output, \
+            self.depth
+        fold = self.fold if self.ignorecase else None
+        state = 0
+        best = None
+        for pos in range(max(init, 0), len(source)):
+            c = source[pos]
+            if fold is not None:
+                c = fold(c)
+            while True:
+                following = goto[state].get(c)
+                if following is not None:
+                    state = following
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            # Any match from here on starts at or after the start of the
+            # text the current state stands for.
+            if best is not None and best[0] < pos + 1 - depth[state]:
+                break
+            found = output[state]
+            if found is not None:
+                start = pos + 1 - found[0]
+                if best is None or start <= best[0]:
+                    best = (start, pos + 1, found[1])
+        if best is None:
+            return None
+        return best[0], best[1], self.needles[best[2]]
+
+    def gmatch(self, source):
+        '''Yield (start, end, needle) for each non-overlapping match in
+        source, from left to right.'''
+        init = 0
+        while True:
+            result = self.find(source, init)
+            if result is None:
+                return
+            yield result
+            init = result[1]
+
+
+def _resultsize(value):
+    '''Return the approximate number of bytes held by a cached key or
+    result: strings and tuples of them, counted through sys.getsizeof().'''
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, frozenset)):
+        for item in value:
+            size += _resultsize(item)
+    return size
+
+
+class ResultCache:
+    '''A least-recently-used cache of find() and gsub() results, for
+    programs that repeat the same calls on the same sources.
+
+    Entries are charged for the size in bytes of their source, key and
+    result, and the least recently used ones are dropped once the total
+    exceeds maxbytes.  A gsub() with a callable repl is never cached, as
+    the callable may have side effects or change its answers; it is run
+    directly and counted in bypasses, as is a mapping with unhashable
+    keys.  A mapping repl is keyed on a snapshot of its items, so changing
+    the mapping never returns stale results, at a cost proportional to its
+    size on every call.
+
+    Counters: hits, misses and bypasses; hitrate is hits over hits plus
+    misses.  Lookups and updates are serialized by a lock, so one cache
+    can be shared between threads.
+    '''
+
+    def __init__(self, maxbytes=1 << 24):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()  # key -> (result, size)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.bypasses = 0
+
+    def __repr__(self):
+        return ('<luapatt.ResultCache: {} entries, {} of {} bytes, '
+                'hitrate={:.2f}>'.format(len(self.entries), self.size,
+                                         self.maxbytes, self.hitrate))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hitrate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        '''Drop every entry and reset the counters.'''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.bypasses = 0
+
+    def find(self, source, pattern, init=0, plain=False, ignorecase=False,
+             ascii=False):
+        key = ('find', source, self.patternkey(pattern, ignorecase, ascii),
+               init, plain)
+        return self.lookup(key, find, source, pattern, init, plain,
+                           ignorecase, ascii)
+
+    def gsub(self, source, pattern, repl, limit=None, count=False,
+             ignorecase=False, ascii=False):
+        args = (source, pattern, repl, limit, count, ignorecase, ascii)
+        if callable(repl):
+            with self.lock:
+                self.bypasses += 1
+            return gsub(*args)
+        if isinstance(repl, Mapping):
+            # Keyed on what subst() makes of each value
+            try:
+                replkey = ('map', frozenset(
+                    (k, None if v is None or v is False else str(v))
+                    for k, v in repl.items()
+                ))
+            except TypeError:  # unhashable keys
+                with self.lock:
+                    self.bypasses += 1
+                return gsub(*args)
+        else:
+            replkey = ('str', str(repl))
+        key = ('gsub', source, self.patternkey(pattern, ignorecase, ascii),
+               replkey, limit, count)
+        return self.lookup(key, gsub, *args)
+
+    def patternkey(self, pattern, ignorecase, ascii):
+        # Keyed without compiling, so that a hit skips the pattern cache
+        # too.  A string pattern depends on the current escape character.
+        if isinstance(pattern, Pattern):
+            return pattern, ignorecase, ascii
+        return pattern, ESCAPE, ignorecase, ascii
+
+    def lookup(self, key, function, *args):
+        with self.lock:
+            try:
+                result, size = self.entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+        result = function(*args)
+        size = _resultsize(key) + _resultsize(result)
+        if size > self.maxbytes:
+            return result  # would evict everything else for one entry
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (result, size)
+                self.size += size
+                while self.size > self.maxbytes:
+                    oldkey, (oldresult, oldsize) = self.entries.popitem(
+                        last=False)
+                    self.size -= oldsize
+        return result
+
+
+def _frontiermask(source, start, stop, test):
+    '''Return one byte per position start..stop-1 of source, 1 where a %f
+    whose set has the predicate test holds there.  stop may be one past
+    the end of source; the ends count as '\0', as in Lua.'''
+    srclen = len(source)
+    edge = b'\x01' if test('\0') else b'\x00'
+    members = bytes(map(test, source[max(start - 1, 0):min(stop, srclen)]))
+    if start == 0:
+        members = edge + members
+    if stop > srclen:
+        members += edge
+    # A frontier is where the previous byte is 0 and this one is 1; big
+    # integers do the bitwise work for all positions at once.
+    size = stop - start
+    following = int.from_bytes(members[1:], 'big')
+    previous = int.from_bytes(members[:-1], 'big')
+    ones = int.from_bytes(b'\x01' * size, 'big')
+    return (following & (previous ^ ones)).to_bytes(size, 'big')
+
+
+_FLIPMASK = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+
+class Source(str):
+    '''A str that keeps what matching works out about its characters, so
+    that many patterns run over the same text share the work.
+
+    It can be passed anywhere a source string is accepted.  Built lazily
+    and kept for the lifetime of the object are: one byte per character
+    for every class, set or literal used by a pattern (1 where the item
+    matches), the positions where every %f frontier holds, and the end of
+    every balanced span found by %b.  The interpreter uses them to skip
+    start positions that cannot match, to measure repetitions with a
+    single bytes.find() and to answer %f and %b without rescanning.
+    Slicing or concatenating gives a plain str.
+    '''
+
+    def __init__(self, text=''):
+        self._masks = {}
+        self._frontiermasks = {}
+        self._balances = {}  # shared by matchers, see balanceend()
+
+    def __repr__(self):
+        return 'luapatt.Source({})'.format(super().__repr__())
+
+    def _mask(self, kind, arg, escape, ignorecase=False, ascii=False):
+        key = (kind, arg, escape, ignorecase, ascii)
+        try:
+            return self._masks[key]
+        except KeyError:
+            pass
+        if kind == 'class' and arg.isupper():
+            mask = self._mask(kind, arg.lower(), escape, ignorecase, ascii)
+            mask = mask.translate(_FLIPMASK)
+        else:
+            predicate = _itempredicate(kind, arg, escape, ignorecase, ascii)
+            mask = bytes(map(predicate, self))
+        self._masks[key] = mask
+        return mask
+
+    def _frontiers(self, arg, escape, ignorecase=False, ascii=False):
+        # One byte per position 0..len(self), 1 where %f[arg] holds
+        key = (arg, escape, ignorecase, ascii)
+        try:
+            return self._frontiermasks[key]
+        except KeyError:
+            pass
+        test = _itempredicate('set', arg, escape, ignorecase, ascii)
+        frontiers = _frontiermask(self, 0, len(self) + 1, test)
+        self._frontiermasks[key] = frontiers
+        return frontiers
+
+
+def _trigramkey(text, pos=0):
+    '''Return the integer key of the three characters of text at pos.'''
+    return ((ord(text[pos]) << 42) | (ord(text[pos + 1]) << 21) |
+            ord(text[pos + 2]))
+
+
+class Index:
+    '''A trigram index of a static corpus, for running many different
+    patterns over it with results identical to a full scan.
+
+    For every three-character substring of the corpus the index holds the
+    sorted positions where it occurs.  A pattern that contains a run of at
+    least three literal characters every match must include is only tried
+    near the occurrences of that run, found through its rarest trigram.
+    Patterns without such a run, ignorecase patterns and patterns with
+    errors are searched with a full scan.
+
+    With path, the index is read from that file if it was written for the
+    same corpus, and built and written there otherwise.  The file is
+    memory-mapped, not read, so opening a large index is immediate; call
+    close() to release it.
+    '''
+
+    _MAGIC = b'LPIDX1' + (b'<' if sys.byteorder == 'little' else b'>')
+    _HEADER = struct.Struct('=7sQQQQ')  # magic, length, crc, keys, positions
+
+    def __init__(self, corpus, path=None):
+        self.corpus = corpus
+        self.checksum = zlib.crc32(corpus.encode('utf-8', 'surrogatepass'))
+        self.plans = {}
+        self.found = {}  # literal -> its positions in the corpus
+        self.mapped = None
+        if path is None or not self._load(path):
+            self._build()
+            if path is not None:
+                self._save(path)
+
+    def __repr__(self):
+        return '<luapatt.Index of {} characters, {} trigrams>'.format(
+            len(self.corpus), len(self.keys))
+
+    def _build(self):
+        corpus = self.corpus
+        numpy = _importnumpy(False)
+        if numpy is not None and len(corpus) >= _NUMPYMINLEN:
+            codes = numpy.frombuffer(
+                corpus.encode('utf-32-le', 'surrogatepass'), dtype='<u4'
+            ).astype(numpy.uint64)
+            keys = (codes[:-2] << 42) | (codes[1:-1] << 21) | codes[2:]
+            order = numpy.argsort(keys, kind='stable')
+            keys, first = numpy.unique(keys[order], return_index=True)
+            offsets = numpy.append(first, len(order))
+            self.keys = array('Q', keys.astype('=u8').tobytes())
+            self.offsets = array('q', offsets.astype('=i8').tobytes())
+            self.positions = array('q', order.astype('=i8').tobytes())
+            return
+        table = {}
+        for pos in range(len(corpus) - 2):
+            table.setdefault(_trigramkey(corpus, pos), []).append(pos)
+        self.keys = array('Q', sorted(table))
+        self.offsets = array('q', [0])
+        self.positions = array('q')
+        for key in self.keys:
+            self.positions.extend(table[key])
+            self.offsets.append(len(self.positions))
+
+    def _save(self, path):
+        header = self._HEADER.pack(self._MAGIC, len(self.corpus),
+                                   self.checksum, len(self.keys),
+                                   len(self.positions))
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(header)
+            f.write(self.keys)
+            f.write(self.offsets)
+            f.write(self.positions)
+        os.replace(tmppath, path)
+
+    def _load(self, path):
+        # Return whether a usable index was mapped from path
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return False
+        with f:
+            header = f.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                return False
+            magic, length, checksum, nkeys, npositions = \
+                self._HEADER.unpack(header)
+            if (magic, length, checksum) != (self._MAGIC, len(self.corpus),
+                                             self.checksum):
+                return False
+            size = self._HEADER.size + 8 * (2 * nkeys + 1 + npositions)
+            if os.fstat(f.fileno()).st_size != size:
+                return False
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        start = self._HEADER.size
+        arrays = []
+        for typecode, count in (('Q', nkeys), ('q', nkeys + 1),
+                                ('q', npositions)):
+            arrays.append(view[start:start + 8 * count].cast(typecode))
+            start += 8 * count
+        self.keys, self.offsets, self.positions = arrays
+        self.mapped = (mapped, view)
+        return True
+
+    def close(self):
+        '''Release the memory-mapped index file, if any; the index can no
+        longer be searched afterwards.'''
+        if self.mapped is not None:
+            mapped, view = self.mapped
+            for arrayview in (self.keys, self.offsets, self.positions, view):
+                arrayview.release()
+            mapped.close()
+            self.mapped = None
+
+    def locate(self, key):
+        '''Return (low, high) such that positions[low:high] are the sorted
+        positions of the trigram with the given key.'''
+        index = bisect.bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return 0, 0
+        return self.offsets[index], self.offsets[index + 1]
+
+    def plan(self, compiled, pp):
+        '''Return (literal, minimum, maximum) to narrow searches for the
+        compiled pattern from pp, or None if it needs a full scan.
+
+        literal is a run of characters every match contains, preceded by
+        at least minimum and at most maximum characters of the match
+        (maximum is None if unbounded).
+        '''
+        key = (compiled, pp)
+        try:
+            return self.plans[key]
+        except KeyError:
+            pass
+        plan = None
+        try:
+            Analysis(compiled)  # errors are left to a full scan to raise
+        except PatternError:
+            compiled = None
+        if compiled is not None and not compiled.ignorecase:
+            items = compiled._parse(pp)
+            best = None
+            index = 0
+            while index < len(items):
+                start = index
+                chars = []
+                while index < len(items):
+                    kind, arg, quant = items[index]
+                    if kind == 'char' and quant is None:
+                        chars.append(arg)
+                    elif kind not in ('open', 'close', 'position'):
+                        break
+                    index += 1
+                literal = ''.join(chars)
+                if len(literal) >= 3:
+                    while items[start][0] != 'char':
+                        start += 1  # leading capture boundaries
+                    rarity = self.rarest(literal)[1]
+                    if best is None or rarity < best[0]:
+                        minimum, maximum, _ = _lengths(items[:start])
+                        best = (rarity, (literal, minimum, maximum))
+                index += 1
+            # Candidates from a common run cost more than a plain scan
+            if best is not None and best[0] * 16 <= len(self.corpus):
+                plan = best[1]
+        self.plans[key] = plan
+        return plan
+
+    def rarest(self, literal):
+        '''Return (offset, count) for the trigram of literal with the
+        fewest occurrences in the corpus.'''
+        best = None
+        for offset in range(len(literal) - 2):
+            low, high = self.locate(_trigramkey(literal, offset))
+            count = high - low
+            if best is None or count < best[1]:
+                best = (offset, count)
+        return best
+
+    def occurrences(self, literal):
+        '''Return the sorted positions where literal occurs in the corpus.'''
+        try:
+            return self.found[literal]
+        except KeyError:
+            pass
+        offset, count = self.rarest(literal)
+        low, high = self.locate(_trigramkey(literal, offset))
+        startswith = self.corpus.startswith
+        positions = [pos - offset for pos in self.positions[low:high]
+                     if pos >= offset and startswith(literal, pos - offset)]
+        self.found[literal] = positions
+        return positions
+
+    def search(self, matcher, type, plan, init):
+        '''Return what matcher.find_aux(type, init) would, trying only start
+        positions near occurrences of the plan's literal.'''
+        literal, minimum, maximum = plan
+        occurrences = self.occurrences(literal)
+        index = bisect.bisect_left(occurrences, init + minimum)
+        while index < len(occurrences):
+            position = occurrences[index]
+            first = init
+            if maximum is not None:
+                first = max(init, position - maximum)
+            last = position - minimum
+            if last - first >= _INDEXMAXTRIES:
+                # No match starts before first, since it would contain an
+                # earlier occurrence, so the next match from first is the
+                # answer
+                return matcher.find_aux(type, first)
+            for start in range(first, last + 1):
+                result = matcher.find_aux(type, start, anchored=True)
+                if result is not None:
+                    return result
+            init = last + 1
+            index = bisect.bisect_left(occurrences, init + minimum, index)
+        return None
+
+    def find(self, pattern, init=0, ignorecase=False, ascii=False):
+        '''Return what find(corpus, pattern, init) would.'''
+        compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+        plan = None if compiled.pattern[:1] == '^' else self.plan(compiled, 0)
+        if plan is None:
+            return compiled.find(self.corpus, init)
+        matcher = compiled._matcher(self.corpus)
+        return self.search(matcher, 'find', plan, max(init, 0))
+
+    def gmatch(self, pattern, ignorecase=False, ascii=False):
+        '''Yield what gmatch(corpus, pattern) would.'''
+        compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+        plan = self.plan(compiled, 0)
+        if plan is None:
+            yield from compiled.gmatch(self.corpus)
+            return
+        matcher = compiled._matcher(self.corpus, noanchor=True)
+        init = 0
+        while True:
+            result = self.search(matcher, 'gmatch', plan, init)
+            if result is None:
+                return
+            init = result[0][1]  # never empty, as it contains the literal
+            yield result[1]
+
+
+_cache = {}
+_cachelock = threading.Lock()
+_MAXCACHE = 512
+_loaded = {}  # patterns read by load_cache(), never evicted
+_CACHEFORMAT = 5
+
+
+def _compile(pattern, codegen=False, ignorecase=False, ascii=False):
+    if isinstance(pattern, Pattern):
+        if codegen or ignorecase or ascii:
+            raise ValueError('cannot pass flags with a compiled pattern')
+        return pattern
+    key = (pattern, ESCAPE, codegen, ignorecase, ascii)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    try:
+        compiled = _loaded[key]
+    except KeyError:
+        compiled = Pattern(pattern, codegen, ignorecase, ascii)
+    with _cachelock:
+        if len(_cache) >= _MAXCACHE:
+            del _cache[next(iter(_cache))]
+        _cache[key] = compiled
+    return compiled
+
+
+####################
+# Public functions #
+####################
+
+
+def set_escape_char(char):
+    global ESCAPE
+    if not isinstance(char, str):
+        raise TypeError('"char" must be a unicode character')
+    if len(char) != 1:
+        raise ValueError('"char" must be a single character')
+    invalidescapes = SPECIALS + ')]'
+    if char in invalidescapes:
+        raise ValueError('"char" cannot be any of "{}"'.format(invalidescapes))
+    ESCAPE = char
+
+
+def compile(pattern, codegen=False, ignorecase=False, ascii=False):
+    return _compile(pattern, codegen, ignorecase, ascii)
+
+
+def analyze(pattern, codegen=False, ignorecase=False, ascii=False):
+    '''Return an Analysis of pattern, for vetting untrusted patterns.
+
+    Raises the syntax or capture error that matching could run into, even
+    if only some sources would reach it.
+    '''
+    return Analysis(_compile(pattern, codegen, ignorecase, ascii))
+
+
+def purge():
+    _cache.clear()
+    _loaded.clear()
+
+
+def save_cache(path):
+    '''Write every cached compiled pattern to the file at path.
+
+    The file is replaced atomically, so processes loading it concurrently
+    never see a partial write.  Returns the number of patterns saved.
+    '''
+    patterns = dict(_loaded)
+    patterns.update(_cache)
+    header = (_CACHEFORMAT, __version__)
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'wb') as f:
+        pickle.dump((header, list(patterns.values())), f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.replace(tmppath, path)
+    return len(patterns)
+
+
+def load_cache(path):
+    '''Load compiled patterns saved by save_cache() from path.
+
+    Loaded patterns are used by compile() and the module functions instead
+    of compiling from scratch, whenever the escape character they were
+    compiled with is the current one.  A missing file, or one written by
+    another version of this module, is ignored.  The file is unpickled, so
+    only load caches from trusted locations.  Returns the number of
+    patterns loaded.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            header, patterns = pickle.load(f)
+    except FileNotFoundError:
+        return 0
+    if header != (_CACHEFORMAT, __version__):
+        return 0
+    count = 0
+    for compiled in patterns:
+        key = (compiled.pattern, compiled.escape, compiled.codegen,
+               compiled.ignorecase, compiled.ascii)
+        _loaded[key] = compiled
+        count += 1
+    return count
+
+
+def find(source, pattern, init=0, plain=False, ignorecase=False,
+         ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.find(source, init, plain)
+
+
+def rfind(source, pattern, end=None, ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.rfind(source, end)
+
+
+def match(source, pattern, init=0, ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.match(source, init)
+
+
+def gmatch(source, pattern, ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.gmatch(source)
+
+
+def contains(source, pattern, init=0, ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.contains(source, init)
+
+
+def count(source, pattern, ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.count(source)
+
+
+def extract_columns(source, pattern, spans=False, numpy=None,
+                    ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.extract_columns(source, spans, numpy)
+
+
+def split(source, pattern, maxsplit=None, captures=False, ignorecase=False,
+          ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.split(source, maxsplit, captures)
+
+
+def gsub(source, pattern, repl, limit=None, count=False, ignorecase=False,
+         ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.gsub(source, repl, limit, count)
+
+
+def find_any(source, needles, init=0, ignorecase=False):
+    '''Return (start, end, needle) for the leftmost occurrence in source of
+    any of needles (a NeedleSet or an iterable of strings), or None.'''
+    if not isinstance(needles, NeedleSet):
+        needles = NeedleSet(needles, ignorecase)
+    return needles.find(source, init)
+
+
+def gmatch_any(source, needles, ignorecase=False):
+    '''Yield (start, end, needle) for each non-overlapping occurrence in
+    source of any of needles (a NeedleSet or an iterable of strings).'''
+    if not isinstance(needles, NeedleSet):
+        needles = NeedleSet(needles, ignorecase)
+    return needles.gmatch(source)
+
+
+def gsub_multi(source, rules, limit=None, count=False, ignorecase=False,
+               ascii=False):
+    '''Apply several substitutions to source in a single pass.
+
+    rules is a sequence of (pattern, repl) pairs, with repl as in gsub().
+    Scanning from the left, the rules are tried in order at each position,
+    and the first one that matches there is applied; scanning resumes
+    where its match ends, as in gsub().  So of all the matches that start
+    at the leftmost possible position, the one from the earliest rule
+    wins, and later rules never see text an earlier replacement produced.
+    Rules starting with '^' only apply at the start of source.  limit caps
+    the total number of substitutions, and count=True also returns it.
+    '''
+    patterns = [_compile(pattern, ignorecase=ignorecase, ascii=ascii)
+                for pattern, repl in rules]
+    repls = [repl for pattern, repl in rules]
+    index = _FirstCharIndex(patterns)
+    matchers = [compiled._matcher(source) for compiled in patterns]
+    srclen = len(source)
+    if limit is None:
+        limit = srclen + 1
+    pieces = []
+    replcount = 0
+    copied = 0  # source before this is already in pieces
+    pos = 0
+    while pos <= srclen and replcount < limit:
+        c = source[pos] if pos < srclen else None
+        for rule in index.candidates(c):
+            matcher = matchers[rule]
+            if matcher.anchor and pos:
+                continue
+            result = matcher.find_aux(type='gsub', init=pos, anchored=True)
+            if result is not None:
+                break
+        else:
+            pos += 1
+            continue
+        replcount += 1
+        (matchstart, matchend), captures = result
+        if copied < matchstart:
+            pieces.append(source[copied:matchstart])
+        pieces.append(matcher.subst(captures, repls[rule], matchstart,
+                                    matchend))
+        pos = copied = matchend
+        if matchstart == matchend:  # empty match?
+            if matchend < srclen:
+                pieces.append(source[matchend])  # skip a character
+            pos = copied = matchend + 1
+    if copied < srclen:
+        pieces.append(source[copied:])
+    finalstring = ''.join(pieces)
+    if count:
+        return finalstring, replcount
+    return finalstring
+
+
+def gsub_iter(source, pattern, repl, limit=None, ignorecase=False,
+              ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.gsub_iter(source, repl, limit)
+
+
+def gsub_to(writer, source, pattern, repl, limit=None, encoding='utf-8',
+            ignorecase=False, ascii=False):
+    compiled = _compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return compiled.gsub_to(writer, source, repl, limit, encoding)
+
+
+##########################
+# Command-line interface #
+##########################
+
+
+def _readfile(path, encoding):
+    '''Return (text, size in bytes) for path, or for stdin if path is '-'.
+
+    Files are memory-mapped and decoded straight from the mapping.
+    Undecodable bytes survive as surrogates, so --in-place output
+    round-trips them.
+    '''
+    if path == '-':
+        data = sys.stdin.buffer.read()
+        return data.decode(encoding, 'surrogateescape'), len(data)
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return str(data, encoding, 'surrogateescape'), len(data)
+        except ValueError:  # empty files cannot be mapped
+            return '', 0
+
+
+def _formatvalue(value):
+    if isinstance(value, tuple):
+        return '\t'.join(map(str, value))
+    return str(value)
+
+
+def _grepfile(job):
+    '''Search or substitute in one file for main().
+
+    Returns (output chunks, (bytes, lines, matches), error message or
+    None).  Runs in worker processes, so it only takes picklable options.
+    '''
+    path, options = job
+    try:
+        text, size = _readfile(path, options['encoding'])
+    except OSError as e:
+        return [], (0, 0, 0), '{}: {}'.format(path, e.strerror or e)
+    compiled = _compile(options['pattern'], ignorecase=options['ignorecase'],
+                        ascii=options['ascii'])
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()  # the text ends with a newline, not an empty line
+    prefix = path + ':' if options['filenames'] else ''
+    output = []
+    matches = 0
+    if options['repl'] is not None:
+        try:
+            for index, line in enumerate(lines):
+                lines[index], replaced = compiled.gsub(line, options['repl'],
+                                                       count=True)
+                matches += replaced
+        except PatternError as e:  # bad replacement, found at the first match
+            return [], (0, 0, 0), str(e)
+        newtext = ''.join(line + '\n' for line in lines)
+        if not text.endswith('\n'):
+            newtext = newtext[:-1]
+        if not options['inplace']:
+            output.append(newtext)
+        elif matches:
+            tmppath = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmppath, 'w', encoding=options['encoding'],
+                      errors='surrogateescape', newline='') as f:
+                f.write(newtext)
+            os.replace(tmppath, path)
+        return output, (size, len(lines), matches), None
+    matchedlines = 0
+    for number, line in enumerate(lines, 1):
+        lineprefix = prefix
+        if options['linenumbers']:
+            lineprefix += '{}:'.format(number)
+        if options['only']:
+            values = list(compiled.gmatch(line))
+            matches += len(values)
+            matchedlines += bool(values)
+            if not options['count']:
+                output.extend(lineprefix + _formatvalue(value) + '\n'
+                              for value in values)
+        elif compiled.contains(line):
+            matches += 1
+            matchedlines += 1
+            if not options['count']:
+                output.append(lineprefix + line + '\n')
+    if options['count']:
+        output.append('{}{}\n'.format(prefix, matchedlines))
+    return output, (size, len(lines), matches), None
+
+
+def main(argv=None):
+    '''Run the luapatt command-line tool; returns the exit status.
+
+    Like grep, prints matching lines (or, with -o, each match or its
+    captures) and exits with 0 if anything matched, 1 if nothing did and 2
+    on errors.  With -s, works like sed instead, replacing matches on every
+    line with gsub().
+    '''
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(
+        prog='python -m luapatt',
+        description='Search files for a Lua pattern, line by line.'
+    )
+    parser.add_argument('pattern')
+    parser.add_argument('files', nargs='*', metavar='file',
+                        help="files to read; '-' or none for stdin")
+    parser.add_argument('-n', '--line-number', action='store_true',
+                        help='prefix output with line numbers')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='print only the number of matching lines')
+    parser.add_argument('-o', '--only-matching', action='store_true',
+                        help='print each match, or its captures separated '
+                             'by tabs')
+    parser.add_argument('-i', '--ignore-case', action='store_true')
+    parser.add_argument('--ascii', action='store_true',
+                        help='use C-locale ASCII character classes')
+    parser.add_argument('-s', '--gsub', metavar='REPL',
+                        help='replace matches with REPL, as gsub() does, '
+                             'and print the result')
+    parser.add_argument('--in-place', action='store_true',
+                        help='with --gsub, rewrite the files instead')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='worker processes (default: one per CPU, up '
+                             'to one per file)')
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--stats', action='store_true',
+                        help='report throughput on stderr')
+    # Like grep, allow options after the files where argparse can
+    parse = getattr(parser, 'parse_intermixed_args', parser.parse_args)
+    args = parse(argv)
+    if args.in_place and args.gsub is None:
+        parser.error('--in-place requires --gsub')
+    files = args.files or ['-']
+    if args.in_place and '-' in files:
+        parser.error('--in-place cannot rewrite stdin')
+    try:
+        analyze(args.pattern, ignorecase=args.ignore_case, ascii=args.ascii)
+    except PatternError as e:
+        print('luapatt: {}'.format(e), file=sys.stderr)
+        return 2
+    options = {
+        'pattern': args.pattern,
+        'ignorecase': args.ignore_case,
+        'ascii': args.ascii,
+        'repl': args.gsub,
+        'inplace': args.in_place,
+        'linenumbers': args.line_number,
+        'count': args.count,
+        'only': args.only_matching,
+        'filenames': len(files) > 1,
+        'encoding': args.encoding,
+    }
+    jobs = [(path, options) for path in files]
+    workers = min(args.jobs or os.cpu_count() or 1, len(jobs))
+    started = time.perf_counter()
+    if workers > 1 and '-' not in files:
+        # Imported here since only multi-file runs need it
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(_grepfile, jobs)
+    else:
+        pool = None
+        results = map(_grepfile, jobs)
+    out = getattr(sys.stdout, 'buffer', None)
+    totals = [0, 0, 0]
+    status = 1
+    try:
+        for output, counts, error in results:
+            if error is not None:
+                print('luapatt: ' + error, file=sys.stderr)
+                status = 2
+                continue
+            for chunk in output:
+                if out is None:
+                    sys.stdout.write(chunk)
+                else:
+                    out.write(chunk.encode(args.encoding, 'surrogateescape'))
+            for index, value in enumerate(counts):
+                totals[index] += value
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    sys.stdout.flush()
+    elapsed = time.perf_counter() - started
+    if args.stats:
+        size, lines, matches = totals
+        print('{} files, {} bytes, {} lines, {} matches in {:.3f}s '
+              '({:.1f} MB/s, {} workers)'.format(
+                  len(files), size, lines, matches, elapsed,
+                  size / 1e6 / elapsed if elapsed else 0.0,
+                  max(workers, 1)),
+              file=sys.stderr)
+    if status != 2 and (totals[2] or args.gsub is not None):
+        status = 0
+    return status
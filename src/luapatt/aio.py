@@ -0,0 +1,144 @@
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+'''Coroutines that run pattern matching in an executor, so that long
+searches do not block the event loop.
+
+Each function takes the arguments of the function of the same name in
+luapatt, plus executor: None for the event loop's default thread pool,
+or any concurrent.futures executor.  gmatch() and split() return lists.
+Patterns are compiled in the calling thread, with the escape character
+in effect there.
+
+Cancelling the coroutine, for example through a timeout of
+asyncio.wait_for(), also stops the work: the search checks a CancelToken
+as it backtracks and gives up at the next checkpoint, freeing the worker.
+With a ProcessPoolExecutor, arguments must be picklable and the token is
+shared through a multiprocessing manager, started on first use.
+'''
+
+import asyncio
+import atexit
+import concurrent.futures
+import multiprocessing
+import threading
+
+import luapatt
+
+# Checkpoints between looks at a token shared with another process, as
+# each look is a round trip to the manager
+_PROCESSINTERVAL = 1 << 12
+
+_GENERATORS = ('gmatch', 'split')
+
+_manager = None
+_managerlock = threading.Lock()
+
+
+def _getmanager():
+    # Started on first use by a process executor, and shut down at exit
+    # so that its server process does not outlive the interpreter
+    global _manager
+    with _managerlock:
+        if _manager is None:
+            _manager = multiprocessing.Manager()
+            atexit.register(_manager.shutdown)
+        return _manager
+
+
+def _token(executor):
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        return luapatt.CancelToken(_getmanager().Event(), _PROCESSINTERVAL)
+    return luapatt.CancelToken()
+
+
+def _call(token, name, args):
+    # Runs in the worker
+    with token:
+        result = getattr(luapatt, name)(*args)
+        if name in _GENERATORS:
+            result = list(result)
+    return result
+
+
+async def _run(executor, name, *args):
+    loop = asyncio.get_event_loop()
+    token = _token(executor)
+    try:
+        return await loop.run_in_executor(executor, _call, token, name, args)
+    except asyncio.CancelledError:
+        token.cancel()
+        raise
+
+
+async def find(source, pattern, init=0, plain=False, ignorecase=False,
+               ascii=False, executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'find', source, compiled, init, plain)
+
+
+async def rfind(source, pattern, end=None, ignorecase=False, ascii=False,
+                executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'rfind', source, compiled, end)
+
+
+async def match(source, pattern, init=0, ignorecase=False, ascii=False,
+                executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'match', source, compiled, init)
+
+
+async def gmatch(source, pattern, ignorecase=False, ascii=False,
+                 executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'gmatch', source, compiled)
+
+
+async def contains(source, pattern, init=0, ignorecase=False, ascii=False,
+                   executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'contains', source, compiled, init)
+
+
+async def count(source, pattern, ignorecase=False, ascii=False,
+                executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'count', source, compiled)
+
+
+async def split(source, pattern, maxsplit=None, captures=False,
+                ignorecase=False, ascii=False, executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'split', source, compiled, maxsplit,
+                      captures)
+
+
+async def gsub(source, pattern, repl, limit=None, count=False,
+               ignorecase=False, ascii=False, executor=None):
+    compiled = luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii)
+    return await _run(executor, 'gsub', source, compiled, repl, limit, count)
+
+
+async def gsub_multi(source, rules, limit=None, count=False,
+                     ignorecase=False, ascii=False, executor=None):
+    rules = [(luapatt.compile(pattern, ignorecase=ignorecase, ascii=ascii),
+              repl) for pattern, repl in rules]
+    return await _run(executor, 'gsub_multi', source, rules, limit, count)
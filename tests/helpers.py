@@ -34,3 +34,34 @@ def checkerror(exc, msg, f, *args):
 
 def syntaxerror(p, m):
     checkerror(luapatt.PatternSyntaxError, m, luapatt.find, 'a', p)
+
+
+# Random patterns and sources for the differential tests
+ITEMS = ['a', 'b', '.', '%a', '%d', '%S', '[ab]', '[^a]', '[%a1-2]', '1', ' ',
+         '(', ')', '()', '%1', '%2', '%b()', '%f[%w]', '[a', '%']
+CAPTUREFREEITEMS = ['a', 'b', '.', '%a', '%d', '%S', '[ab]', '[^a]', '[%a1]',
+                    '1', ' ', '%.', '^']
+QUANTIFIERS = ['*', '+', '-', '?']
+
+def randompattern(rng, items, quantified, endanchored):
+    pattern = ''.join(
+        rng.choice(items) +
+        (rng.choice(QUANTIFIERS) if rng.random() < quantified else '')
+        for _ in range(rng.randint(1, 6))
+    )
+    if rng.random() < 0.2:
+        pattern = '^' + pattern
+    if rng.random() < endanchored:
+        pattern += '$'
+    return pattern
+
+def randomsource(rng, alphabet):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+
+def interpreted(pattern, source, type, init=0):
+    # Always the backtracking interpreter, whatever engine compile() picks
+    compiled = luapatt.compile(pattern)
+    noanchor = type == 'gmatch'
+    return luapatt._PatternMatcher(source, compiled, noanchor).find_aux(
+        type=type, init=init
+    )
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Tests for luapatt.aio and the CancelToken it relies on.
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import sys
+import threading
+import time
+sys.path.insert(0, r'src')
+
+import pytest
+
+import luapatt
+
+if sys.version_info < (3, 5):
+    pytest.skip('luapatt.aio needs Python 3.5', allow_module_level=True)
+
+from luapatt import aio
+
+
+# Backtracks for far longer than any test waits
+SLOW = ('a' * 3000, '(.-)(.-)(.-)b')
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+### CANCEL TOKEN
+
+def test_token_stops_search():
+    token = luapatt.CancelToken()
+    timer = threading.Timer(0.1, token.cancel)
+    timer.start()
+    with pytest.raises(luapatt.PatternCancelled):
+        with token:
+            luapatt.find(*SLOW)
+    assert token.cancelled
+    assert luapatt.find('ab', 'b') == (1, 2)  # no token in effect any more
+
+def test_token_checks_every_engine():
+    token = luapatt.CancelToken()
+    token.cancel()
+    for pattern in ('a+b', '(a+)b', luapatt.compile('(a+)b', codegen=True)):
+        with token:
+            with pytest.raises(luapatt.PatternCancelled):
+                luapatt.find('aaab', pattern)
+
+def test_token_interval():
+    token = luapatt.CancelToken(interval=1000)
+    token.cancel()
+    with token:
+        # Fewer checkpoints than the interval, so the flag is never read
+        assert luapatt.find('ab', '(b)') == (1, 2, 'b')
+        with pytest.raises(luapatt.PatternCancelled):
+            luapatt.find(*SLOW)
+
+
+### COROUTINES
+
+def test_results():
+    source = 'key = a1, b22'
+    assert run(aio.find(source, '(%w+) =')) == (0, 5, 'key')
+    assert run(aio.rfind(source, '%d')) == (12, 13)
+    assert run(aio.match(source, '%a+', 6)) == 'a'
+    assert run(aio.gmatch(source, '%d+')) == ['1', '22']
+    assert run(aio.contains(source, 'B', ignorecase=True))
+    assert run(aio.count(source, '%a')) == 5
+    assert run(aio.split(source, ',%s*')) == ['key = a1', 'b22']
+    assert run(aio.gsub(source, '%d', '#', count=True)) == (
+        'key = a#, b##', 3)
+    assert run(aio.gsub_multi(source, [('%d', '#'), ('%a+', '<%0>')])) == (
+        '<key> = <a>#, <b>##')
+
+def test_timeout_frees_thread():
+    executor = ThreadPoolExecutor(1)
+    with pytest.raises(asyncio.TimeoutError):
+        run(asyncio.wait_for(aio.find(*SLOW, executor=executor), 0.2))
+    start = time.time()
+    assert run(aio.count('x1 x2', 'x%d', executor=executor)) == 2
+    assert time.time() - start < 5
+    executor.shutdown()
+
+def test_process_executor():
+    executor = ProcessPoolExecutor(1)
+    assert run(aio.find('hello', '(l+)', executor=executor)) == (2, 4, 'll')
+    with pytest.raises(asyncio.TimeoutError):
+        run(asyncio.wait_for(aio.find(*SLOW, executor=executor), 0.5))
+    start = time.time()
+    assert run(aio.gmatch('x1 x2', 'x%d', executor=executor)) == ['x1', 'x2']
+    assert time.time() - start < 10
+    executor.shutdown()
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Tests for the command-line tool, run through main() in this process.
+
+import sys
+sys.path.insert(0, r'src')
+
+import pytest
+
+import luapatt
+
+
+LOG = 'GET /a 200\nPOST /b 404\nGET /c 500\n'
+
+
+def run(capsys, *argv):
+    status = luapatt.main(list(argv))
+    out, err = capsys.readouterr()
+    return status, out, err
+
+
+### GREP MODE
+
+def test_matching_lines(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '-n', '^GET', str(path))
+    assert status == 0
+    assert out == '1:GET /a 200\n3:GET /c 500\n'
+
+def test_no_match_status(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    assert run(capsys, 'PUT', str(path)) == (1, '', '')
+
+def test_only_matching_captures(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '-o', '(%u+) %S+ (%d+)', str(path))
+    assert out == 'GET\t200\nPOST\t404\nGET\t500\n'
+
+def test_count_several_files(tmpdir, capsys):
+    first, second = tmpdir.join('a.log'), tmpdir.join('b.log')
+    first.write(LOG)
+    second.write('')
+    status, out, err = run(capsys, '-c', '-j', '1', '4%d%d',
+                           str(first), str(second))
+    assert out == '{}:1\n{}:0\n'.format(first, second)
+
+def test_worker_pool_keeps_file_order(tmpdir, capsys):
+    paths = []
+    for index in range(4):
+        path = tmpdir.join('{}.log'.format(index))
+        path.write('x{}\n'.format(index) * (index + 1))
+        paths.append(str(path))
+    status, out, err = run(capsys, '-c', '-j', '2', 'x', *paths)
+    assert out == ''.join('{}:{}\n'.format(path, index + 1)
+                          for index, path in enumerate(paths))
+
+def test_missing_file(tmpdir, capsys):
+    status, out, err = run(capsys, 'x', str(tmpdir.join('missing')))
+    assert status == 2
+    assert 'missing' in err
+
+def test_stats(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '-c', '--stats', '%d+', str(path))
+    assert err.startswith('1 files, 34 bytes, 3 lines, 3 matches in ')
+
+
+### GSUB MODE
+
+def test_gsub_to_stdout(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '-s', '<%1>', '(%d+)$', str(path))
+    assert status == 0
+    assert out == 'GET /a <200>\nPOST /b <404>\nGET /c <500>\n'
+    assert path.read() == LOG
+
+def test_gsub_in_place(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write('x=1\ny=2')
+    status, out, err = run(capsys, '-s', '%2=%1', '(%a)=(%d)', '--in-place',
+                           str(path))
+    assert out == ''
+    assert path.read() == '1=x\n2=y'
+
+def test_in_place_stdin(capsys):
+    with pytest.raises(SystemExit) as excinfo:
+        luapatt.main(['-s', 'X', 'a', '--in-place'])
+    assert excinfo.value.code == 2
+    out, err = capsys.readouterr()
+    assert '--in-place' in err
+
+
+### ERRORS
+
+def test_invalid_pattern(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '(', str(path))
+    assert status == 2
+    assert out == ''
+    assert err == 'luapatt: unfinished capture\n'
+
+def test_invalid_replacement(tmpdir, capsys):
+    path = tmpdir.join('a.log')
+    path.write(LOG)
+    status, out, err = run(capsys, '-s', '%2', 'GET', '--in-place',
+                           str(path))
+    assert status == 2
+    assert err == 'luapatt: invalid capture index %2\n'
+    assert path.read() == LOG
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Differential tests: patterns compiled with codegen=True must behave exactly
+# like the interpreter in _PatternMatcher, errors included.
+
+import random
+import sys
+sys.path.insert(0, r'src')
+
+import pytest
+
+import luapatt
+
+from helpers import ITEMS, interpreted, randompattern, randomsource
+
+
+ALPHABET = 'ab(). 1'
+
+
+def outcome(f, *args):
+    try:
+        return f(*args)
+    except luapatt.PatternError as e:
+        return type(e), str(e)
+
+
+def compare(source, pattern):
+    generated = luapatt.compile(pattern, codegen=True)
+    for type in ('find', 'match', 'gmatch', 'gsub'):
+        for init in range(len(source) + 2):
+            matcher = generated._matcher(source, type == 'gmatch')
+            assert (outcome(matcher.find_aux, type, init) ==
+                    outcome(interpreted, pattern, source, type, init))
+
+
+@pytest.mark.parametrize('source, pattern', [
+    ('alo xyzK', '(%w+)K'),
+    ('hello world from Lua', '^(%w+)%s*(%w+)$'),
+    ('key = value', '^(%w+)%s*=%s*(.-)$'),
+    ('xuxx uu ppar r', '()(.)%2'),
+    ('f(a(b)(c(d)))x', '%b()x'),
+    ('THE (quick) fox', '%f[%a]%a+'),
+    ('a.b.c', '(.*)%.'),
+    ('a.b.c', '(.-)%.'),
+    ('abc', '(a'),
+    ('abc', 'a)'),
+    ('abc', '(a)%2'),
+    ('abc', 'b[c'),
+])
+def test_codegen_known(source, pattern):
+    compare(source, pattern)
+
+
+def test_codegen_random():
+    rng = random.Random(1234)
+    for _ in range(3000):
+        pattern = randompattern(rng, ITEMS, 0.4, 0.2)
+        source = randomsource(rng, ALPHABET)
+        compare(source, pattern)
+
+
+def test_codegen_is_used():
+    pattern = luapatt.compile('(%a+)=(%a+)', codegen=True)
+    assert isinstance(pattern._matcher('a=b'), luapatt._CodeMatcher)
+
+
+def test_codegen_deep_pattern_falls_back():
+    pattern = luapatt.compile('.?' * luapatt.MAXRECURSION, codegen=True)
+    assert not isinstance(pattern._matcher('a'), luapatt._CodeMatcher)
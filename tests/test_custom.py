@@ -23,6 +23,8 @@
 import sys
 sys.path.insert(0, r'src')
 
+import pytest
+
 import luapatt
 
 from helpers import checkerror
@@ -84,3 +86,734 @@ def test_too_many_captures():
 
 def test_minexpand_fail():
     assert luapatt.find('test', 'te-x') is None
+
+
+### SINGLE-ITEM QUANTIFIER FAST PATHS
+
+def test_dot_star_to_end():
+    assert luapatt.match('key = value', '= (.*)') == 'value'
+
+def test_literal_run():
+    assert luapatt.find('xaaaaaaaaaab', 'a*b') == (1, 12)
+    assert luapatt.find('xaaaaaaaaaab', 'a+b') == (1, 12)
+
+def test_literal_run_long():
+    s = 'a' * 10000 + 'b'
+    assert luapatt.match(s, '^(a*)b$') == 'a' * 10000
+
+def test_set_run():
+    assert luapatt.match('abc123def', '[%a_]+') == 'abc'
+
+def test_greedy_next_literal():
+    assert luapatt.match('a=b=c', '(.*)=') == 'a=b'
+    assert luapatt.match('a=b=c', '(%a*)=') == 'a'
+
+def test_lazy_next_literal():
+    assert luapatt.match('a=b=c', '(.-)=') == 'a'
+    assert luapatt.match('ab=b=c', '(%a-)=') == 'ab'
+    assert luapatt.match('a1=b=c', '^(%a-)=') is None
+
+
+### BALANCED MATCHING
+
+def test_balance_nested():
+    assert luapatt.match('f(a(b)(c(d)))x', '%b()') == '(a(b)(c(d)))'
+    assert luapatt.find('f(a(b)(c(d)))x', '%b()') == (1, 13)
+
+def test_balance_gmatch_reuses_spans():
+    s = '(a(b)) ((c) (d'
+    assert list(luapatt.gmatch(s, '%b()')) == ['(a(b))', '(c)']
+
+def test_balance_unclosed_inner():
+    assert luapatt.find('(((x)', '%b()') == (2, 5)
+
+def test_balance_same_delimiters():
+    assert luapatt.match('|a|b|', '%b||') == '|a|'
+
+
+### COMPILED PATTERNS
+
+def test_compile_methods():
+    p = luapatt.compile('(%w+)=(%w+)')
+    assert p.find('a b=c') == (2, 5, 'b', 'c')
+    assert p.match('a b=c') == ('b', 'c')
+    assert list(p.gmatch('a=b c=d')) == [('a', 'b'), ('c', 'd')]
+    assert p.gsub('a=b c=d', '%2=%1') == 'b=a d=c'
+
+def test_compile_in_module_functions():
+    p = luapatt.compile('%d+')
+    assert luapatt.find('abc 123', p) == (4, 7)
+
+def test_compile_keeps_escape():
+    p = luapatt.compile('%d')
+    luapatt.set_escape_char('@')
+    try:
+        assert p.match('x1') == '1'
+        assert luapatt.match('x1', '@d') == '1'
+    finally:
+        luapatt.set_escape_char('%')
+
+
+### PICKLING AND THE COMPILE CACHE
+
+def test_pickle_pattern():
+    import pickle
+    p = luapatt.compile('(%a+)=(%d+)', codegen=True)
+    assert p.match('x=1') == ('x', '1')
+    q = pickle.loads(pickle.dumps(p))
+    assert q.pattern == p.pattern and q.escape == '%' and q.codegen
+    assert q._sources == p._sources
+    assert q.match('x=1') == ('x', '1')
+
+def test_pickle_keeps_program():
+    import pickle
+    p = luapatt.compile('[%d]%d*x')
+    assert p.find('a12x') == (1, 4)
+    q = pickle.loads(pickle.dumps(p))
+    assert q._optimized == '%d+x'
+    assert q._items == p._items
+
+def test_save_load_cache(tmpdir):
+    path = str(tmpdir.join('patterns.cache'))
+    luapatt.purge()
+    luapatt.compile('%d+').find('abc 123')
+    assert luapatt.save_cache(path) == 1
+    luapatt.purge()
+    assert luapatt.load_cache(path) == 1
+    assert luapatt.compile('%d+') is luapatt._loaded[
+        '%d+', '%', False, False, False]
+    assert luapatt.find('abc 123', '%d+') == (4, 7)
+    luapatt.purge()
+
+def test_load_cache_missing_or_stale(tmpdir):
+    import pickle
+    path = str(tmpdir.join('patterns.cache'))
+    assert luapatt.load_cache(path) == 0
+    with open(path, 'wb') as f:
+        pickle.dump(((luapatt._CACHEFORMAT, '0.0'), []), f)
+    assert luapatt.load_cache(path) == 0
+
+def test_cache_eviction_threads():
+    import threading
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(2000):
+                luapatt.find('x', 'a{}_{}'.format(n, i))
+        except Exception as e:
+            errors.append(e)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(luapatt._cache) <= luapatt._MAXCACHE
+    luapatt.purge()
+
+
+### MATCH LENGTH ANALYSIS
+
+def test_lengths():
+    def lengths(p):
+        return luapatt._lengths(luapatt._parse(p, '%'))
+    assert lengths('a%d?b') == (2, 3, False)
+    assert lengths('%a+$') == (1, None, True)
+    assert lengths('(ab)%1') == (4, 4, False)
+    assert lengths('%b()') == (2, None, False)
+    assert lengths('ab[') == (2, None, False)
+
+def test_min_length_prunes_starts():
+    assert luapatt.find('xxxxab', 'ab%d?') == (4, 6)
+    assert luapatt.find('xxxxa', 'ab') is None
+    assert luapatt.find('ab', 'ab', 3) is None
+
+def test_fixed_width_end_anchor():
+    assert luapatt.find('ab ab ab', 'ab$') == (6, 8)
+    assert luapatt.find('ab ab ab', '(a)(b)$') == (6, 8, 'a', 'b')
+    assert luapatt.find('ab ab ab', 'a%a?$') == (6, 8)
+    assert luapatt.find('ab ab a', 'a%a?$') == (6, 7)
+    assert luapatt.gsub('ab ab ab', '%a%a$', 'X') == 'ab ab X'
+    assert luapatt.find('ab', 'ab$', 1) is None
+
+
+### STREAMING GSUB
+
+def test_gsub_iter():
+    pieces = list(luapatt.gsub_iter('hello world', '%w+', '<%0>'))
+    assert ''.join(pieces) == '<hello> <world>'
+    assert '' not in pieces
+
+def test_gsub_iter_chunks():
+    chunks = ['ab 1', '2 c', 'd3 ', '', '45']
+    expected = luapatt.gsub(''.join(chunks), '%d%d?', '#')
+    assert ''.join(luapatt.gsub_iter(chunks, '%d%d?', '#')) == expected
+
+def test_gsub_iter_chunks_frontier_and_end():
+    chunks = ['a', 'a a', 'aa', ' a']
+    source = ''.join(chunks)
+    for pattern in ('%f[%w]a', 'a$', '^a', ' ?a'):
+        assert (''.join(luapatt.gsub_iter(chunks, pattern, 'x')) ==
+                luapatt.gsub(source, pattern, 'x'))
+
+def test_gsub_iter_chunks_unbounded():
+    checkerror(ValueError, 'bounded match length',
+               lambda: list(luapatt.gsub_iter(['a'], 'a+', 'x')))
+
+def test_gsub_to_text():
+    import io
+    out = io.StringIO()
+    assert luapatt.gsub_to(out, 'a b c', '%a', '%0%0', 2) == 2
+    assert out.getvalue() == 'aa bb c'
+
+def test_gsub_to_binary():
+    import io
+    out = io.BytesIO()
+    assert luapatt.gsub_to(out, ['caf', 'é é'], 'é', 'e') == 2
+    assert out.getvalue() == b'cafe e'
+
+
+### SPLIT
+
+def test_split():
+    assert list(luapatt.split('a, b,c', ',%s*')) == ['a', 'b', 'c']
+    assert list(luapatt.split('abc', ',')) == ['abc']
+    assert list(luapatt.split('', ',')) == ['']
+
+def test_split_maxsplit():
+    assert list(luapatt.split('a,b,c', ',', 1)) == ['a', 'b,c']
+    assert list(luapatt.split('a,b,c', ',', 0)) == ['a,b,c']
+
+def test_split_empty_matches():
+    assert list(luapatt.split('abc', 'x*')) == ['', 'a', 'b', 'c', '']
+    assert list(luapatt.split('a1b', '%d*')) == ['', 'a', '', 'b', '']
+
+def test_split_captures():
+    assert (list(luapatt.split('a=1;b=2', '([=;])', captures=True)) ==
+            ['a', '=', '1', ';', 'b', '=', '2'])
+    assert (list(luapatt.split('ab12cd', '()%d+()', captures=True)) ==
+            ['ab', 2, 4, 'cd'])
+    assert list(luapatt.split('a;b', ';', captures=True)) == ['a', 'b']
+
+def test_split_anchored():
+    assert list(luapatt.split(',a,b', '^,')) == ['', 'a,b']
+    assert list(luapatt.split(',a,b', '^,', 0)) == [',a,b']
+    assert list(luapatt.split(',a,b', '^,', 5)) == ['', 'a,b']
+
+
+### CONTAINS AND COUNT
+
+def test_contains():
+    assert luapatt.contains('abc 123', '%d%d')
+    assert not luapatt.contains('abc', '%d')
+    assert luapatt.contains('abc', 'bc')
+    assert not luapatt.contains('abc', 'ab', 1)
+    assert not luapatt.contains('xabc', '^ab')
+    assert not luapatt.contains('abc', '', 10)
+    assert not luapatt.contains('abc', '()', 10)
+    assert luapatt.contains('abc', '', 3)
+    assert luapatt.contains('abc', 'a', -5)
+
+def test_count():
+    assert luapatt.count('first second word', '%w+') == 3
+    assert luapatt.count('abcde', '()') == 6
+    assert luapatt.count('aaaa', 'aa') == 2
+    assert luapatt.count('a^b', '^b') == 1  # no anchoring, as in gmatch
+    assert luapatt.count('abc', 'x') == 0
+
+def test_count_matches_gmatch():
+    source = 'xuxx uu ppar r 12 3'
+    for pattern in ('()(.)%2', '%d*', '%f[%w]', '.-', '%s'):
+        assert (luapatt.count(source, pattern) ==
+                sum(1 for _ in luapatt.gmatch(source, pattern)))
+
+def test_count_unmatched_paren():
+    checkerror(luapatt.PatternSyntaxError, "unmatched ')'",
+               luapatt.count, 'a)b', ')')
+    checkerror(luapatt.PatternSyntaxError, "unmatched ')'",
+               list, luapatt.gmatch('a)b', ')'))
+
+
+### COLUMNAR EXTRACTION
+
+def test_extract_columns():
+    names, positions, values = luapatt.extract_columns(
+        'a=1 b=22 c=3', '(%a)=()(%d+)', numpy=False
+    )
+    assert names == ['a', 'b', 'c']
+    assert list(positions) == [2, 6, 11]
+    assert values == ['1', '22', '3']
+
+def test_extract_columns_spans():
+    whole, starts, ends = luapatt.extract_columns('ab  cd', '%a+',
+                                                  spans=True, numpy=False)
+    assert whole == ['ab', 'cd']
+    assert list(starts) == [0, 4]
+    assert list(ends) == [2, 6]
+
+def test_extract_columns_lines():
+    lines = ['GET /a 200', 'garbage', 'POST /b 404']
+    methods, codes, rows, starts, ends = luapatt.extract_columns(
+        lines, '^(%u+) %S+ (%d+)$', spans=True, numpy=False
+    )
+    assert methods == ['GET', 'POST']
+    assert codes == ['200', '404']
+    assert list(rows) == [0, 2]
+    assert list(starts) == [0, 0]
+    assert list(ends) == [10, 11]
+
+def test_extract_columns_numpy():
+    numpy = pytest.importorskip('numpy')
+    positions, = luapatt.extract_columns('a b c', '()%a', numpy=True)
+    assert isinstance(positions, numpy.ndarray)
+    assert positions.tolist() == [0, 2, 4]
+
+
+### CASE-INSENSITIVE MATCHING
+
+def test_ignorecase_literals_and_sets():
+    assert luapatt.find('Hello WORLD', 'world', ignorecase=True) == (6, 11)
+    assert luapatt.match('ABC', '^[a-b]+', ignorecase=True) == 'AB'
+    assert luapatt.match('xyz', '[^X]+', ignorecase=True) == 'yz'
+    assert luapatt.gsub('aAbB', 'a', '-', ignorecase=True) == '--bB'
+    assert luapatt.find('Hello', 'world', ignorecase=True) is None
+
+def test_ignorecase_classes_unchanged():
+    assert luapatt.match('abcDEF', '%l+', ignorecase=True) == 'abc'
+    assert luapatt.match('abcDEF', '[%u]+', ignorecase=True) == 'DEF'
+
+def test_ignorecase_backref_and_plain():
+    assert luapatt.match('abAB', '(%a+)%1', ignorecase=True) == 'ab'
+    assert luapatt.find('x A.B', 'a.b', plain=True, ignorecase=True) == (2, 5)
+
+def test_ignorecase_engines_agree():
+    for codegen in (False, True):
+        p = luapatt.compile('k(%a-)=[A-Z]', codegen=codegen, ignorecase=True)
+        assert p.match('xKey=v') == 'ey'
+    assert luapatt.compile('[a-c]+', ignorecase=True).engine == 'dfa'
+    assert luapatt.count('abcABC', 'b', ignorecase=True) == 2
+
+def test_ignorecase_with_compiled_pattern():
+    p = luapatt.compile('a', ignorecase=True)
+    assert luapatt.find('A', p) == (0, 1)
+    with pytest.raises(ValueError):
+        luapatt.find('A', p, ignorecase=True)
+
+
+### ASCII CLASSES
+
+def test_ascii_classes():
+    assert luapatt.gsub('é1²x', '%w', '.', ascii=True) == 'é.².'
+    assert luapatt.gsub('é1²x', '%w', '.') == '....'
+    assert luapatt.gsub('a\x1cb', '%s', '_', ascii=True) == 'a\x1cb'
+    assert luapatt.gsub('$+!', '%p', '.', ascii=True) == '...'
+    assert luapatt.match('é!', '%W+', ascii=True) == 'é!'
+    assert luapatt.match('\x7f ~', '%c%s%g', ascii=True) == '\x7f ~'
+
+def test_ascii_sets_and_engines():
+    for codegen in (False, True):
+        p = luapatt.compile('([%a_][%w_]*)=%d', codegen=codegen, ascii=True)
+        assert p.match('ñ=1 key_2=3') == 'key_2'
+    assert luapatt.compile('[^%a]+', ascii=True).engine == 'dfa'
+    assert luapatt.find('aé', '[^%a]', ascii=True) == (1, 2)
+    assert repr(luapatt.compile('%a', ascii=True)) == \
+        "luapatt.compile('%a', ascii=True)"
+
+
+### REVERSE SEARCH
+
+def test_rfind():
+    assert luapatt.rfind('a1 b22 c3', '(%a)(%d+)') == (7, 9, 'c', '3')
+    assert luapatt.rfind('a1 b22 c3', '(%a)(%d+)', 6) == (3, 6, 'b', '22')
+    assert luapatt.rfind('a1 b22 c3', '(%a)(%d+)', -4) == (3, 5, 'b', '2')
+    assert luapatt.rfind('abc', 'x') is None
+    assert luapatt.rfind('abc', '') == (3, 3)
+
+def test_rfind_anchors_and_prefix():
+    assert luapatt.rfind('ab ab', '^ab') == (0, 2)
+    assert luapatt.rfind('ab ab', 'a.$') == (3, 5)
+    s = 'x' * 100000 + 'END 7\n'
+    assert luapatt.rfind(s, 'END (%d)') == (100000, 100005, '7')
+    assert luapatt.rfind('aaa', 'a+') == (2, 3)
+
+def test_rfind_end_bounds_matches():
+    source = 'x(ab) aab) a%'
+    patterns = ['a+$', '%b()', '%f[%A]', 'a-b', '(a*)%1', 'b%)', ' a']
+    for pattern in patterns:
+        for codegen in (False, True):
+            compiled = luapatt.compile(pattern, codegen=codegen)
+            for end in range(-2, len(source) + 1):
+                expected = compiled.rfind(source[:end])
+                assert compiled.rfind(source, end) == expected
+                assert compiled.rfind(luapatt.Source(source), end) == expected
+
+def test_rfind_raises_where_find_would():
+    checkerror(luapatt.PatternSyntaxError, 'invalid capture index',
+               luapatt.rfind, 'ab', 'b%1')
+    assert luapatt.rfind('ab', 'x%1') is None
+
+
+### PATTERN ANALYSIS
+
+def test_analyze_summary():
+    a = luapatt.analyze('^key=(%a+)()')
+    assert a.captures == 2
+    assert (a.minlength, a.maxlength) == (5, None)
+    assert a.engine == 'backtrack'
+    assert a.literals == ('key=',)
+    assert a.risk == 'low' and a.warnings == []
+    assert luapatt.analyze('xa+b').literals == ('xa', 'ab')
+    assert luapatt.analyze('a%d?b').maxlength == 3
+
+def test_analyze_risks():
+    assert luapatt.analyze('(%d*%d*)x').risk == 'medium'
+    assert luapatt.analyze('(.*.*.*)x').risk == 'high'
+    assert luapatt.analyze('(%a*)%d*').risk == 'low'
+    assert luapatt.analyze('(a+)b%1').risk == 'medium'
+    assert luapatt.analyze('(.-)x$').risk == 'medium'
+    assert luapatt.analyze('^(.-)x$').risk == 'low'
+
+def test_analyze_dfa_is_low_risk():
+    a = luapatt.analyze('%d*%d*x')
+    assert a.engine == 'dfa' and a.risk == 'low'
+    assert len(a.warnings) == 1
+
+def test_analyze_raises_errors():
+    checkerror(luapatt.PatternSyntaxError, 'unfinished capture',
+               luapatt.analyze, 'x(a')
+    checkerror(luapatt.PatternSyntaxError, 'invalid capture index',
+               luapatt.analyze, 'x%1')
+    checkerror(luapatt.PatternSyntaxError, "unmatched ')'",
+               luapatt.analyze, 'x)')
+    checkerror(luapatt.PatternSyntaxError, "missing ']'",
+               luapatt.analyze, 'x[a')
+
+
+### SCANNER
+
+def test_scanner_tokens():
+    scanner = luapatt.Scanner([
+        ('%s+', None),
+        ('%a[%w_]*', 'name'),
+        ('%d+', lambda scanner, value: ('number', int(value))),
+        ('"([^"]*)"', 'string'),
+        ('^[=;]', 'op'),
+    ])
+    tokens = list(scanner.scan('x = 42; y = "hi"'))
+    assert tokens == [('name', 'x'), ('op', '='), ('number', 42),
+                      ('op', ';'), ('name', 'y'), ('op', '='),
+                      ('string', 'hi')]
+    assert list(scanner.scan('x = 1', 4)) == [('number', 1)]
+
+def test_scanner_order_and_empty_matches():
+    scanner = luapatt.Scanner([('%d*', 'maybe'), ('if', 'kw'),
+                               ('%a+', 'name')])
+    assert list(scanner.scan('iffy1')) == [('kw', 'if'), ('name', 'fy'),
+                                           ('maybe', '1')]
+
+def test_scanner_error():
+    scanner = luapatt.Scanner([('%a+', 'name')])
+    with pytest.raises(luapatt.ScanError) as info:
+        list(scanner.scan('ab?'))
+    assert info.value.pos == 2
+    assert str(info.value) == 'no token matches at position 2'
+
+def test_find_aux_anchored():
+    matcher = luapatt.compile('%d+')._matcher('ab12')
+    assert matcher.find_aux('find', 1, anchored=True) is None
+    assert matcher.find_aux('find', 2, anchored=True) == (2, 4)
+    matcher = luapatt.compile('(%d)%d')._matcher('ab12')
+    assert matcher.find_aux('find', 0, anchored=True) is None
+
+
+### MULTI-SUBSTITUTION
+
+def test_gsub_multi_leftmost_then_first_rule():
+    rules = [('cat', 'dog'), ('%a+', '<%0>'), ('dog', 'cat')]
+    assert luapatt.gsub_multi('cat dog', rules) == 'dog <dog>'
+    assert luapatt.gsub_multi('a1b22', [('%d+', '#'), ('%a', '_')],
+                              count=True) == ('_#_#', 4)
+
+def test_gsub_multi_repl_kinds_and_limit():
+    rules = [('(%a)=(%d)', '%2=%1'), ('%[(%w+)%]', {'x': 'X'}),
+             ('!', lambda whole: '?')]
+    assert luapatt.gsub_multi('a=1 [x] [y]!', rules) == '1=a X [y]?'
+    assert luapatt.gsub_multi('aaa', [('a', 'b')], limit=2) == 'bba'
+
+def test_gsub_multi_matches_gsub():
+    for pattern in ('', 'x*', '^a', 'a$', '%f[%w]%w+', '%b()'):
+        for source in ('', 'abc', '(a)x(b)', 'xaxa'):
+            assert (luapatt.gsub_multi(source, [(pattern, '<%0>')]) ==
+                    luapatt.gsub(source, pattern, '<%0>'))
+
+
+### MULTI-NEEDLE PLAIN SEARCH
+
+def test_find_any():
+    needles = ['he', 'she', 'his', 'hers']
+    assert luapatt.find_any('ushers', needles) == (1, 4, 'she')
+    assert luapatt.find_any('ushers', needles, 2) == (2, 6, 'hers')
+    assert luapatt.find_any('ushers', ['x', 'y']) is None
+    assert luapatt.find_any('a.b', ['.']) == (1, 2, '.')
+
+def test_gmatch_any():
+    needles = luapatt.NeedleSet(['ab', 'abc', 'bcd', 'c'])
+    assert list(luapatt.gmatch_any('abcd abd c', needles)) == [
+        (0, 3, 'abc'), (5, 7, 'ab'), (9, 10, 'c')]
+
+def test_needles_ignorecase():
+    needles = luapatt.NeedleSet(['Spam', 'EGGS'], ignorecase=True)
+    assert list(needles.gmatch('SPAM and eggs')) == [
+        (0, 4, 'Spam'), (9, 13, 'EGGS')]
+    assert luapatt.find_any('SPAM', ['spam']) is None
+
+def test_needles_empty():
+    with pytest.raises(ValueError):
+        luapatt.NeedleSet(['a', ''])
+
+
+### NUMPY RUN DETECTION
+
+def run_results(pattern, source):
+    p = luapatt.Pattern(pattern)
+    return (list(p.gmatch(source)), p.count(source),
+            p.gsub(source, '<%0>', 7, count=True))
+
+def test_runs_match_fallback(monkeypatch):
+    pytest.importorskip('numpy')
+    source = 'ab 12_\t.é١Ω ' * 500
+    for pattern in ('%d+', '[%w_]+', '%s+', '[^%s]+', 'b+'):
+        assert luapatt.Pattern(pattern)._runspans(source) is not None
+        expected = run_results(pattern, source)
+        with monkeypatch.context() as m:
+            m.setattr(luapatt, '_importnumpy', lambda required: None)
+            assert run_results(pattern, source) == expected
+
+def test_runs_not_used():
+    source = 'a' * luapatt._NUMPYMINLEN
+    for pattern in ('^a+', 'a*', '(a+)', 'a+b'):
+        assert luapatt.Pattern(pattern)._runspans(source) is None
+    assert luapatt.Pattern('a+')._runspans('aaa') is None
+
+
+### OPTIMIZER
+
+def test_optimizer_rewrites():
+    assert luapatt.compile('[a]b').program == 'ab'
+    assert luapatt.compile('[%d]x').program == '%dx'
+    assert luapatt.compile('%d%d*').program == '%d+'
+    assert luapatt.compile('a*a').program == 'a+'
+    assert luapatt.compile('x.-$').program == 'x.*$'
+    assert luapatt.compile('(.-)()$').program == '(.*)()$'
+    assert luapatt.compile('^[%^]x').program == '^%^x'
+    assert luapatt.compile('^*a').program == '^*a'
+    assert luapatt.compile('a-b$').program == 'a-b$'
+    assert luapatt.compile('[a]b%').program == '[a]b%'
+
+def test_optimizer_results():
+    cases = [('aaab', '^a[a]*b'), ('x = 1;', '(.-)=.-$'), ('k:v', '[k]:(.)'),
+             ('dd', '[%%]?d'), ('a.b', '[.]b')]
+    for source, pattern in cases:
+        for codegen in (False, True):
+            compiled = luapatt.compile(pattern, codegen=codegen)
+            assert compiled.program != pattern
+            assert compiled.find(source) == luapatt.Pattern(
+                compiled.program).find(source)
+    assert luapatt.find('x = 1;', '(.-)=.-$') == (0, 6, 'x ')
+
+def test_optimizer_plain_find():
+    # A pattern without specials is still searched for as written
+    assert luapatt.find('a.b[c]', '[c]', plain=True) == (3, 6)
+
+def test_explain():
+    assert luapatt.compile('^ke[y]=%d%d*').explain() == '\n'.join([
+        "pattern '^ke[y]=%d%d*'",
+        "program '^key=%d+'",
+        "engine  dfa",
+        "  anchor",
+        "  literal  'key='",
+        "  class    %d +",
+    ])
+    lines = luapatt.compile('(%b())[ab]-%1').explain().splitlines()
+    assert lines[3:] == ['  open', '  balance  %b()', '  close',
+                         '  set      [ab] -', '  backref  %1']
+
+
+### RESULT CACHE
+
+def test_result_cache_hits():
+    cache = luapatt.ResultCache()
+    for _ in range(3):
+        assert cache.gsub('a-b', '%-', '_') == 'a_b'
+        assert cache.gsub('a-b', '%-', '_', count=True) == ('a_b', 1)
+        assert cache.find('key=val', '(%w+)=') == (0, 4, 'key')
+    assert (cache.hits, cache.misses, len(cache)) == (6, 3, 3)
+    assert cache.hitrate == 6 / 9
+    cache.clear()
+    assert (cache.hits, cache.misses, cache.size, len(cache)) == (0, 0, 0, 0)
+
+def test_result_cache_keys():
+    cache = luapatt.ResultCache()
+    assert cache.gsub('x1', '%d', 1) == 'x1'
+    assert cache.gsub('x1', '%d', 1.0) == 'x1.0'
+    assert cache.gsub('x1', '%d', '%%') == 'x%'
+    table = {'a': 'A'}
+    assert cache.gsub('ab', '%w', table) == 'Ab'
+    table['b'] = 'B'
+    assert cache.gsub('ab', '%w', table) == 'AB'
+    assert cache.gsub('ab', '%w', {'a': False, 'b': 0}) == 'a0'
+    assert cache.find('aA', 'A') == (1, 2)
+    assert cache.find('aA', 'A', ignorecase=True) == (0, 1)
+    assert cache.hits == 0
+
+def test_result_cache_bypass():
+    cache = luapatt.ResultCache()
+    calls = []
+    for _ in range(2):
+        assert cache.gsub('ab', '%w', lambda c: calls.append(c)) == 'ab'
+    assert calls == ['a', 'b', 'a', 'b']
+    assert cache.gsub('ab', '%w', {'a': 'z', 'b': ['y']}) == "z['y']"
+    assert cache.bypasses == 2 and len(cache) == 1
+
+def test_result_cache_eviction():
+    cache = luapatt.ResultCache(maxbytes=3000)
+    for n in range(20):
+        cache.gsub('x' * 200 + str(n), '%d', '#')
+        assert cache.size <= 3000
+    assert 0 < len(cache) < 20
+    cache.gsub('x' * 200 + '19', '%d', '#')
+    assert cache.hits == 1  # the most recent entry survives
+    cache.gsub('x' * 200 + '0', '%d', '#')
+    assert cache.hits == 1  # the oldest one was evicted
+    assert cache.gsub('y' * 5000, 'y', 'z') == 'z' * 5000
+    assert cache.size <= 3000  # too big to cache at all
+
+
+### SOURCE OBJECT
+
+def test_source_is_str():
+    source = luapatt.Source('key = (a (b) c) 12')
+    assert source == 'key = (a (b) c) 12' and isinstance(source, str)
+    assert repr(source) == "luapatt.Source('key = (a (b) c) 12')"
+    assert type(source[1:]) is str
+
+def test_source_results():
+    text = 'The (quick (brown)) fox, 12 jumps; OVER 3.5 dogs'
+    source = luapatt.Source(text)
+    for pattern in ('%f[%w]%w+', '%b()', '(%d+)', '%f[%u](%u+)', '(%a-)s',
+                    '()%f[%p]', '%S+%f[%s]', '(%w+)%1', '[%d.]+'):
+        for flags in ({}, {'codegen': True}, {'ignorecase': True},
+                      {'ascii': True}):
+            compiled = luapatt.compile(pattern, **flags)
+            assert list(compiled.gmatch(source)) == list(compiled.gmatch(text))
+            assert compiled.gsub(source, '<%0>') == compiled.gsub(text, '<%0>')
+            assert compiled.find(source, 9) == compiled.find(text, 9)
+
+def test_source_shares_work():
+    source = luapatt.Source('x (a) (b (c)) y')
+    assert luapatt.find(source, '%b()') == (2, 5)
+    assert luapatt.find(source, '[%a]%f[%A]', 3) == (3, 4)
+    assert luapatt.count(source, '(%a+)') == 5
+    assert set(source._masks) == {('char', '(', '%', False, False),
+                                  ('class', 'a', '%', False, False)}
+    assert source._balances == {'()': {2: 5}}
+    assert luapatt.match(source, '(%b())', 6) == '(b (c))'
+    assert source._balances == {'()': {2: 5, 6: 13, 9: 12}}
+    assert source._frontiers('%A', '%') == bytes([0, 1, 0, 0, 1, 0, 0, 0, 1,
+                                                  0, 0, 1, 0, 0, 0, 1])
+
+
+### FRONTIER SEARCH
+
+def test_frontier_mask():
+    test = luapatt._itempredicate('set', '%w', '%')
+    text = 'ab, c'
+    assert luapatt._frontiermask(text, 0, 6, test) == bytes([1, 0, 0, 0, 1, 0])
+    assert luapatt._frontiermask(text, 1, 5, test) == bytes([0, 0, 0, 1])
+    test = luapatt._itempredicate('set', '%z', '%')
+    assert luapatt._frontiermask(text, 3, 6, test) == bytes([0, 0, 1])
+
+def test_frontier_search(monkeypatch):
+    text = 'one, two;  three 4five. ' * 5
+    patterns = ['%f[%w]%w+', '(%f[%a]%a+)', '()%f[%W]', '%f[%z]', '%f[%l]']
+    expected = [list(luapatt.gmatch(text, p)) for p in patterns]
+    for size in (1, 2, 7, 4096):
+        monkeypatch.setattr(luapatt, '_FRONTIERBLOCK', size)
+        assert [list(luapatt.gmatch(text, p)) for p in patterns] == expected
+        assert luapatt.find(text, '%f[%d]%w+', 20) == (41, 46)
+
+def test_frontier_search_skips_positions(monkeypatch):
+    tried = []
+    match = luapatt._PatternMatcher.match
+    def tracking(self, sp, pp):
+        if pp == 0:
+            tried.append(sp)
+        return match(self, sp, pp)
+    monkeypatch.setattr(luapatt._PatternMatcher, 'match', tracking)
+    assert list(luapatt.gmatch('ab cd  ef', '%f[%w]%w+')) == ['ab', 'cd', 'ef']
+    assert tried == [0, 3, 7]
+
+
+### TRIGRAM INDEX
+
+INDEXCORPUS = ''.join('item{} = (val{}) ok\n'.format(n, n * 7)
+                      for n in range(300))
+INDEXPATTERNS = ['item12 ', 'item1(%d) = %((%w+)', '%a+42 ', '(val)1%d+',
+                 '%f[%w]val21%f[%W]', 'm29.-ok$', '^item0', 'missing',
+                 '%b()', '(%d+) = %(val2']
+
+def test_index_results(monkeypatch):
+    for size in (luapatt._NUMPYMINLEN, 1 << 40):  # with and without NumPy
+        monkeypatch.setattr(luapatt, '_NUMPYMINLEN', size)
+        index = luapatt.Index(INDEXCORPUS)
+        for pattern in INDEXPATTERNS:
+            assert (list(index.gmatch(pattern)) ==
+                    list(luapatt.gmatch(INDEXCORPUS, pattern)))
+            for init in (-5, 0, 40, 4000, 99999):
+                assert (index.find(pattern, init) ==
+                        luapatt.find(INDEXCORPUS, pattern, init))
+        assert (index.find('ITEM12 ', ignorecase=True) ==
+                luapatt.find(INDEXCORPUS, 'ITEM12 ', ignorecase=True))
+
+def test_index_plan():
+    index = luapatt.Index(INDEXCORPUS)
+    assert index.plan(luapatt.compile('item1(%d) = %('), 0) == (
+        'item1', 0, 0)
+    assert index.plan(luapatt.compile('%d%d? = %(val9'), 0) == (
+        ' = (val9', 1, 2)
+    assert index.plan(luapatt.compile('%a+ = %(val9'), 0) == (
+        ' = (val9', 1, None)
+    common = luapatt.compile('cab')
+    assert luapatt.Index('abc' * 100).plan(common, 0) is None
+    assert index.plan(luapatt.compile('(v%a)l1'), 0) is None  # too short
+    assert index.plan(luapatt.compile('item12(%1'), 0) is None
+    assert index.plan(luapatt.compile('item12', ignorecase=True), 0) is None
+    assert index.occurrences('item29') == [
+        pos for pos in range(len(INDEXCORPUS))
+        if INDEXCORPUS.startswith('item29', pos)]
+
+def test_index_errors():
+    index = luapatt.Index(INDEXCORPUS)
+    checkerror(luapatt.PatternSyntaxError, 'invalid capture index',
+               index.find, 'item12 =%2')
+
+def test_index_file(tmpdir):
+    path = str(tmpdir.join('corpus.idx'))
+    built = luapatt.Index(INDEXCORPUS, path)
+    assert built.mapped is None
+    loaded = luapatt.Index(INDEXCORPUS, path)
+    assert loaded.mapped is not None
+    assert list(loaded.keys) == list(built.keys)
+    assert list(loaded.positions) == list(built.positions)
+    assert list(loaded.gmatch('(val)1%d+')) == list(built.gmatch('(val)1%d+'))
+    loaded.close()
+    changed = luapatt.Index(INDEXCORPUS + 'x', path)  # stale, so rebuilt
+    assert changed.mapped is None
+    assert luapatt.Index(INDEXCORPUS + 'x', path).mapped is not None
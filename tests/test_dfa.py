@@ -0,0 +1,90 @@
+# coding: utf-8
+
+# Copyright 2015 Jonathan Goble
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+# Differential tests: capture-free patterns run by the DFA engine must give
+# exactly the results of the backtracking interpreter in _PatternMatcher.
+
+import random
+import sys
+sys.path.insert(0, r'src')
+
+import pytest
+
+import luapatt
+
+from helpers import (CAPTUREFREEITEMS, interpreted, randompattern,
+                     randomsource)
+
+
+ALPHABET = 'ab1 .'
+
+
+def compare(source, pattern, init=0):
+    compiled = luapatt.compile(pattern)
+    assert compiled.engine == 'dfa'
+    for type in ('find', 'match', 'gmatch', 'gsub'):
+        matcher = luapatt._DFAMatcher(source, compiled, type == 'gmatch')
+        assert (matcher.find_aux(type=type, init=init) ==
+                interpreted(pattern, source, type, init))
+
+
+@pytest.mark.parametrize('source, pattern', [
+    ('hello world', '%a+'),
+    ('hello world', 'o.-o'),
+    ('hello world', 'o.*o'),
+    ('aaab', 'a-b'),
+    ('aaab', '^a-$'),
+    ('key = value', '%s*=%s*'),
+    ('abc', ''),
+    ('abc', 'x*'),
+    ('abab', 'b?a?b$'),
+    ('a.b.c', '%.%a$'),
+])
+def test_dfa_known(source, pattern):
+    for init in range(len(source) + 2):
+        compare(source, pattern, init)
+
+
+def test_dfa_random():
+    rng = random.Random(4321)
+    for _ in range(3000):
+        pattern = randompattern(rng, CAPTUREFREEITEMS, 0.6, 0.3)
+        source = randomsource(rng, ALPHABET)
+        compare(source, pattern, rng.randint(0, len(source)))
+
+
+def test_dfa_engine_choice():
+    assert luapatt.compile('%d+%.?%d*').engine == 'dfa'
+    assert luapatt.compile('^[%w_]+$').engine == 'dfa'
+    assert luapatt.compile('(%d+)').engine == 'backtrack'
+    assert luapatt.compile('%b()').engine == 'backtrack'
+    assert luapatt.compile('%f[%w]%w+').engine == 'backtrack'
+    assert luapatt.compile('(.)%1').engine == 'backtrack'
+    assert luapatt.compile('%d+', codegen=True).engine == 'codegen'
+
+
+def test_dfa_linear_time():
+    # Quadratic or worse for a backtracking matcher
+    source = 'a' * 100000
+    assert luapatt.find(source, 'a*a*b') is None
+    assert luapatt.count(source + 'b', 'a*a*b') == 1